@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Benchmark rendering a page of the index grid, with and without precomputed
+coinbase card block binaries. A development script, run from the repository
+root against a populated database, e.g.
+
+    python bench/benchindex.py --path '/?filter=inscription' --repeat 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ordinalsarchive.settings")
+
+import django
+
+django.setup()
+
+from bits.blockchain import Block
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from pages import views
+
+
+def recompute_block_binary(content) -> str:
+    # what the index did before block binaries were precomputed
+    return Block(content.block.serialized()).bin()
+
+
+def time_index(request, repeat: int) -> tuple:
+    """
+    Render the index repeat times
+    Returns:
+        tuple: (render times in seconds, queries per render)
+    """
+    views.index(request)  # warm up, also fills missing block binaries
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            views.index(request)
+            timings.append(time.perf_counter() - start)
+    return timings, len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--path",
+        default="/",
+        help="index url to render, with query string, e.g. '/?filter=inscription'",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=50,
+        help="number of renders timed",
+    )
+    args = parser.parse_args()
+
+    # results component only, as loaded by htmx when scrolling
+    request = RequestFactory().get(args.path, HTTP_HX_REQUEST="true")
+    runs = {"precomputed": time_index(request, args.repeat)}
+    with mock.patch.object(views, "card_block_binary", recompute_block_binary):
+        runs["recomputed"] = time_index(request, args.repeat)
+    for name, (timings, queries) in runs.items():
+        print(
+            f"{name}: median {statistics.median(timings) * 1000:.2f}ms, "
+            f"min {min(timings) * 1000:.2f}ms, max {max(timings) * 1000:.2f}ms "
+            f"per page ({queries} queries) over {args.repeat} renders"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -94,6 +94,17 @@ DATABASES = {
     }
 }
 
+# per process by default; a shared backend lets the indexer invalidate entries
+# served by the web processes
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.environ.get("DJANGO_CACHE_LOCATION", ""),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -139,6 +150,14 @@ STATIC_ROOT = os.environ.get("DJANGO_STATIC_ROOT", BASE_DIR / "static")
 MEDIA_ROOT = Path(os.environ.get("DJANGO_MEDIA_ROOT", BASE_DIR / "media"))
 MEDIA_URL = os.environ.get("DJANGO_MEDIA_URL", "/media/")
 
+# offload media file serving to the front proxy: "x-accel-redirect" (nginx)
+# or "x-sendfile" (apache, lighttpd)
+MEDIA_SENDFILE = os.environ.get("DJANGO_MEDIA_SENDFILE")
+# internal nginx location aliased to MEDIA_ROOT, for x-accel-redirect
+MEDIA_SENDFILE_PREFIX = os.environ.get(
+    "DJANGO_MEDIA_SENDFILE_PREFIX", "/protected-media/"
+)
+
 if not MEDIA_ROOT.exists():
     MEDIA_ROOT.mkdir()
 
@@ -175,6 +194,39 @@ S3_ACCESS_KEY = os.environ.get("DJANGO_S3_ACCESS_KEY")
 S3_SECRET_KEY = os.environ.get("DJANGO_S3_SECRET_KEY")
 S3_BUCKET_NAME = os.environ.get("DJANGO_S3_BUCKET_NAME")
 S3_ENDPOINT_URL = os.environ.get("DJANGO_S3_ENDPOINT_URL")
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("DJANGO_S3_MAX_POOL_CONNECTIONS", 32))
+S3_CONNECT_TIMEOUT = float(os.environ.get("DJANGO_S3_CONNECT_TIMEOUT", 5))
+S3_READ_TIMEOUT = float(os.environ.get("DJANGO_S3_READ_TIMEOUT", 30))
+S3_MAX_ATTEMPTS = int(os.environ.get("DJANGO_S3_MAX_ATTEMPTS", 5))
+S3_CACHE_DIR = Path(os.environ.get("DJANGO_S3_CACHE_DIR", BASE_DIR / "s3cache"))
+S3_CACHE_MAX_SIZE = int(os.environ.get("DJANGO_S3_CACHE_MAX_SIZE", 1024**3))
+S3_CACHE_CHUNK_SIZE = int(os.environ.get("DJANGO_S3_CACHE_CHUNK_SIZE", 256 * 1024))
+S3_UPLOAD_WORKERS = int(os.environ.get("DJANGO_S3_UPLOAD_WORKERS", 4))
+S3_UPLOAD_QUEUE_SIZE = int(os.environ.get("DJANGO_S3_UPLOAD_QUEUE_SIZE", 16))
+S3_UPLOAD_SPOOL_DIR = Path(
+    os.environ.get("DJANGO_S3_UPLOAD_SPOOL_DIR", BASE_DIR / "uploadspool")
+)
+# archive blocks compressed in independently decompressible frames
+S3_BLOCK_COMPRESSION = (
+    True
+    if os.environ.get("DJANGO_S3_BLOCK_COMPRESSION") in ["1", "True", "true"]
+    else False
+)
+S3_BLOCK_FRAME_SIZE = int(os.environ.get("DJANGO_S3_BLOCK_FRAME_SIZE", 128 * 1024))
+BLOCK_JSON_CACHE_DIR = Path(
+    os.environ.get("DJANGO_BLOCK_JSON_CACHE_DIR", BASE_DIR / "blockjson")
+)
+BLOCK_JSON_CACHE_MAX_SIZE = int(
+    os.environ.get("DJANGO_BLOCK_JSON_CACHE_MAX_SIZE", 1024**3)
+)
+FACETS_CACHE_TIMEOUT = int(os.environ.get("DJANGO_FACETS_CACHE_TIMEOUT", 60))
+SEARCH_CACHE_TIMEOUT = int(os.environ.get("DJANGO_SEARCH_CACHE_TIMEOUT", 600))
+SEARCH_CACHE_MAX_RESULTS = int(os.environ.get("DJANGO_SEARCH_CACHE_MAX_RESULTS", 1200))
+
+BITCOIND_BLOCKS_DIR = os.environ.get("DJANGO_BITCOIND_BLOCKS_DIR")
+BITCOIND_BLOCK_INDEX = Path(
+    os.environ.get("DJANGO_BITCOIND_BLOCK_INDEX", BASE_DIR / "blockfileindex.bin")
+)
 
 WALLET_XPUB = os.environ.get("DJANGO_WALLET_XPUB")
 WALLET_LIGHTNING_SEED = os.environ.get("DJANGO_WALLET_LIGHTNING_SEED")
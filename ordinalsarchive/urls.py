@@ -24,8 +24,10 @@ from pages import views
 urlpatterns = [
     path("", views.index),
     path("block/<str:block_identifier>", views.block),
-    path("context/<int:context_id>", views.context),
-    path("context/revision/<int:context_id>", views.context_revision),
+    path("block/<str:block_identifier>/raw", views.block_raw),
+    path("context/<int:context_id>", views.context_legacy),
+    path("context/<str:content_hash>", views.context),
+    path("context/revision/<str:content_hash>", views.context_revision),
     path("content_types", views.content_types),
     path("block_info", views.block_info),
     path("lit", views.lit),
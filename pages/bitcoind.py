@@ -0,0 +1,241 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import bits.crypto
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+# network magic bytes prefixing each block record in blk*.dat files
+NETWORK_MAGIC = {
+    bytes.fromhex("f9beb4d9"): "mainnet",
+    bytes.fromhex("0b110907"): "testnet",
+    bytes.fromhex("1c163f28"): "testnet4",
+    bytes.fromhex("0a03cf40"): "signet",
+    bytes.fromhex("fabfb5da"): "regtest",
+}
+NULL_HASH = b"\x00" * 32
+BLK_FILENAME = re.compile(r"blk(\d{5})\.dat")
+
+# height-indexed records: file number, offset of block in file, block size, block hash
+INDEX_MAGIC = b"OABI"
+INDEX_RECORD = struct.Struct("<III32s")
+
+
+class BlockFileIndex:
+    """
+    Read raw blocks from a Bitcoin Core blocks directory by height
+
+    blk*.dat files are memory-mapped and blocks are located through a
+    height -> (file, offset, size) index of the active chain, which is built
+    once by scanning block headers and stored at index_path. The index is
+    extended, from the last indexed file onwards, when a height past the tip
+    is requested. Reads may come from several threads; building, extending
+    and saving the index are serialized.
+    """
+
+    def __init__(self, blocks_dir: Path | str, index_path: Path | str):
+        self.blocks_dir = Path(blocks_dir)
+        self.index_path = Path(index_path)
+        self.chain: List[Tuple[int, int, int, bytes]] = []
+        self._mmaps: Dict[int, mmap.mmap] = {}
+        self._lock = threading.Lock()
+        # held while the chain is rebuilt, extended or saved
+        self._index_lock = threading.RLock()
+
+        xor_path = self.blocks_dir / "xor.dat"
+        self.xor_key = xor_path.read_bytes() if xor_path.exists() else b""
+        if not any(self.xor_key):
+            self.xor_key = b""
+
+        if self.index_path.exists():
+            self.load()
+
+    def load(self):
+        data = self.index_path.read_bytes()
+        if data[:4] != INDEX_MAGIC:
+            raise ValueError(f"{self.index_path} is not a block file index")
+        self.chain = list(INDEX_RECORD.iter_unpack(data[4:]))
+        log.info(f"Loaded block file index with tip at height {self.height}.")
+
+    def save(self):
+        with self._index_lock:
+            tmp_path = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+            with tmp_path.open("wb") as fp:
+                fp.write(INDEX_MAGIC)
+                for record in self.chain:
+                    fp.write(INDEX_RECORD.pack(*record))
+            tmp_path.replace(self.index_path)
+
+    @property
+    def height(self) -> int:
+        return len(self.chain) - 1
+
+    def file_numbers(self) -> List[int]:
+        return sorted(
+            int(match.group(1))
+            for match in (
+                BLK_FILENAME.fullmatch(path.name)
+                for path in self.blocks_dir.glob("blk*.dat")
+            )
+            if match
+        )
+
+    def _mmap(self, file_no: int) -> mmap.mmap:
+        with self._lock:
+            blk = self._mmaps.get(file_no)
+            if blk is None or blk.size() > len(blk):
+                # (re)map files which have grown since being mapped
+                with (self.blocks_dir / f"blk{file_no:05d}.dat").open("rb") as fp:
+                    blk = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mmaps[file_no] = blk
+            return blk
+
+    def _read(self, file_no: int, offset: int, size: int) -> bytes:
+        data = self._mmap(file_no)[offset : offset + size]
+        if self.xor_key and data:
+            # xor.dat obfuscation key is applied relative to the file position
+            key_len = len(self.xor_key)
+            start = offset % key_len
+            key = (self.xor_key * ((start + len(data)) // key_len + 1))[
+                start : start + len(data)
+            ]
+            data = (
+                int.from_bytes(data, "little") ^ int.from_bytes(key, "little")
+            ).to_bytes(len(data), "little")
+        return data
+
+    def scan(self, file_no: int, offset: int = 0) -> Dict[bytes, tuple]:
+        """
+        Scan block records in file_no, starting from offset, and all later files
+        Returns:
+            dict: block hash -> (prev block hash, file number, offset, size)
+        """
+        records = {}
+        for file_no_ in self.file_numbers():
+            if file_no_ < file_no:
+                continue
+            pos = offset if file_no_ == file_no else 0
+            if not (self.blocks_dir / f"blk{file_no_:05d}.dat").stat().st_size:
+                continue
+            file_size = len(self._mmap(file_no_))
+            while pos + 88 <= file_size:
+                record_header = self._read(file_no_, pos, 88)
+                magic = record_header[:4]
+                if magic not in NETWORK_MAGIC:
+                    # remainder of file is preallocated, but not yet written
+                    break
+                size = int.from_bytes(record_header[4:8], "little")
+                header = record_header[8:88]
+                block_hash = bits.crypto.hash256(header)
+                records[block_hash] = (header[4:36], file_no_, pos + 8, size)
+                pos += 8 + size
+            log.info(f"Scanned blk{file_no_:05d}.dat. {len(records)} blocks found.")
+        return records
+
+    def build(self):
+        """
+        Build index of the active chain from a full scan of blk*.dat files
+        """
+        with self._index_lock:
+            log.info(f"Building block file index from {self.blocks_dir} ...")
+            self.chain = []
+            self._extend(self.scan(0))
+            self.save()
+            log.info(f"Block file index built with tip at height {self.height}.")
+
+    def update(self):
+        """
+        Extend the index with blocks written since it was built
+        """
+        with self._index_lock:
+            if not self.chain:
+                return self.build()
+            last_file_no = max(record[0] for record in self.chain[-1000:])
+            tip = self.height
+            self._extend(self.scan(last_file_no))
+            self.save()
+            log.info(f"Block file index updated from height {tip} to {self.height}.")
+
+    def _extend(self, records: Dict[bytes, tuple]):
+        # heights of block hashes already on the indexed chain, recent reorgs
+        # may connect to any of these
+        heights = {
+            self.chain[height][3]: height
+            for height in range(max(0, len(self.chain) - 1000), len(self.chain))
+        }
+        heights[NULL_HASH] = -1
+        children = {}
+        for block_hash, (prev_hash, *_) in records.items():
+            children.setdefault(prev_hash, []).append(block_hash)
+
+        # assign heights walking forward from blocks connecting to the known chain
+        tip_hash, tip_height = None, self.height
+        queue = [prev_hash for prev_hash in children if prev_hash in heights]
+        while queue:
+            prev_hash = queue.pop()
+            for block_hash in children.get(prev_hash, []):
+                if block_hash in heights:
+                    continue
+                heights[block_hash] = heights[prev_hash] + 1
+                if heights[block_hash] > tip_height:
+                    tip_hash, tip_height = block_hash, heights[block_hash]
+                queue.append(block_hash)
+        if tip_hash is None:
+            return
+
+        # walk back from the new tip until reaching the indexed chain
+        new_chain = []
+        block_hash = tip_hash
+        while block_hash in records:
+            prev_hash, file_no, offset, size = records[block_hash]
+            new_chain.append((file_no, offset, size, block_hash))
+            height = heights[block_hash]
+            if height - 1 < len(self.chain) and (
+                height == 0 or self.chain[height - 1][3] == prev_hash
+            ):
+                break
+            block_hash = prev_hash
+        new_chain.reverse()
+        fork_height = tip_height - len(new_chain) + 1
+        if fork_height < len(self.chain):
+            log.warning(f"Block file index reorganized from height {fork_height}.")
+        self.chain[fork_height:] = new_chain
+
+    def read_block(self, blockheight: int) -> bytes:
+        """
+        Return raw block at blockheight, updating the index if needed
+        """
+        if blockheight > self.height:
+            with self._index_lock:
+                # another thread may have extended the index while waiting
+                if blockheight > self.height:
+                    self.update()
+        with self._index_lock:
+            if blockheight < 0 or blockheight > self.height:
+                raise ValueError(f"Block {blockheight} not found in {self.blocks_dir}")
+            file_no, offset, size, _ = self.chain[blockheight]
+        return self._read(file_no, offset, size)
+
+
+_block_file_index = None
+
+
+def get_block_file_index() -> BlockFileIndex:
+    """
+    Return process-wide BlockFileIndex for settings.BITCOIND_BLOCKS_DIR
+    """
+    global _block_file_index  # pylint: disable=global-statement
+    if _block_file_index is None:
+        if not settings.BITCOIND_BLOCKS_DIR:
+            raise ValueError("DJANGO_BITCOIND_BLOCKS_DIR not set")
+        _block_file_index = BlockFileIndex(
+            settings.BITCOIND_BLOCKS_DIR, settings.BITCOIND_BLOCK_INDEX
+        )
+    return _block_file_index
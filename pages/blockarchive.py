@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from bits.blockchain import Block
+from django.conf import settings
+from django.utils import timezone
+
+from . import models
+from .utils import (
+    evict_lru,
+    get_object_head_from_s3,
+    get_s3_client,
+    iter_object_from_s3,
+    read_object_from_s3,
+)
+
+log = logging.getLogger(__name__)
+
+# compressed block object: header, frame index of compressed frame end offsets,
+# then frames, each compressed independently so any byte range of the raw
+# block can be read by fetching and decompressing only the frames covering it
+FRAMED_MAGIC = b"OABZ"
+FRAMED_HEADER = struct.Struct("<4sIQI")  # magic, frame size, raw size, frames
+FRAMED_INDEX_ENTRY = struct.Struct("<I")
+# bytes read speculatively to get header and frame index in one request
+FRAMED_PREFIX_SIZE = 4096
+
+
+def compress_block(raw_block: bytes, frame_size: int) -> bytes:
+    """
+    Compress raw block into framed, seekable format
+    """
+    buf = memoryview(raw_block)
+    frames = [
+        zlib.compress(buf[i : i + frame_size])
+        for i in range(0, len(raw_block), frame_size)
+    ]
+    index = []
+    end = 0
+    for frame in frames:
+        end += len(frame)
+        index.append(FRAMED_INDEX_ENTRY.pack(end))
+    header = FRAMED_HEADER.pack(FRAMED_MAGIC, frame_size, len(raw_block), len(frames))
+    return b"".join([header, *index, *frames])
+
+
+class FramedObject:
+    """
+    Compressed block object in s3, read by frame
+    """
+
+    def __init__(self, key: str, etag: str = ""):
+        self.key = key
+        self.etag = etag
+        prefix = read_object_from_s3(key, 0, FRAMED_PREFIX_SIZE, etag)
+        magic, self.frame_size, self.size, number_of_frames = FRAMED_HEADER.unpack_from(
+            prefix
+        )
+        if magic != FRAMED_MAGIC:
+            raise ValueError(f"{key} is not a framed block object")
+        self.data_start = (
+            FRAMED_HEADER.size + number_of_frames * FRAMED_INDEX_ENTRY.size
+        )
+        if len(prefix) < self.data_start:
+            prefix += read_object_from_s3(
+                key, len(prefix), self.data_start - len(prefix), etag
+            )
+        self.frame_ends: List[int] = [
+            end
+            for (end,) in FRAMED_INDEX_ENTRY.iter_unpack(
+                prefix[FRAMED_HEADER.size : self.data_start]
+            )
+        ]
+
+    def frame_range(self, frame: int) -> Tuple[int, int]:
+        """
+        Return (offset, size) of compressed frame in the object
+        """
+        start = self.frame_ends[frame - 1] if frame else 0
+        return self.data_start + start, self.frame_ends[frame] - start
+
+    def iter(self, offset: int = 0, limit: int = -1) -> Iterator[bytes]:
+        """
+        Yield limit bytes of the raw block from offset, or through the end of
+        the block if limit is -1, one decompressed frame at a time
+        """
+        end = self.size if limit == -1 else min(offset + limit, self.size)
+        if offset >= end:
+            return
+        for frame in range(offset // self.frame_size, (end - 1) // self.frame_size + 1):
+            frame_offset, frame_size = self.frame_range(frame)
+            data = zlib.decompress(
+                read_object_from_s3(self.key, frame_offset, frame_size, self.etag)
+            )
+            frame_start = frame * self.frame_size
+            yield data[max(offset - frame_start, 0) : end - frame_start]
+
+
+def record_object(key: str, size: int, etag: str, uploaded_at: datetime = None):
+    """
+    Add or update object in the s3 manifest
+    """
+    models.S3Object.objects.update_or_create(
+        key=key,
+        defaults={
+            "size": size,
+            "etag": etag.strip('"'),
+            "uploaded_at": uploaded_at or timezone.now(),
+        },
+    )
+
+
+def get_object_size(key: str) -> int | None:
+    """
+    Return size of object per the s3 manifest, or None if it's not archived
+    """
+    return (
+        models.S3Object.objects.filter(key=key).values_list("size", flat=True).first()
+    )
+
+
+def sync_manifest(prefix: str = "block") -> int:
+    """
+    Add or update all objects in the s3 bucket with keys starting with prefix
+    in the s3 manifest, one bulk upsert per listing page
+    Returns:
+        int: number of objects listed
+    """
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    listed = 0
+    for page in paginator.paginate(Bucket=settings.S3_BUCKET_NAME, Prefix=prefix):
+        objects = [
+            models.S3Object(
+                key=obj["Key"],
+                size=obj["Size"],
+                etag=obj["ETag"].strip('"'),
+                uploaded_at=obj["LastModified"],
+            )
+            for obj in page.get("Contents", [])
+        ]
+        models.S3Object.objects.bulk_create(
+            objects,
+            update_conflicts=True,
+            unique_fields=["key"],
+            update_fields=["size", "etag", "uploaded_at"],
+        )
+        listed += len(objects)
+        log.info(f"{listed} objects listed in s3 ...")
+    return listed
+
+
+def find_block_object(blockheight: int) -> Tuple[str, int, str] | None:
+    """
+    Find the block's object in s3, compressed or not, per the s3 manifest or,
+    if it isn't recorded there, e.g. archived by another indexer or uploaded
+    from the spool without being recorded, per s3, recording it
+    Returns:
+        Tuple[str, int, str]: key, size and etag of the object, or None if
+            the block isn't archived
+    """
+    keys = [f"block{blockheight}.binz", f"block{blockheight}.bin"]
+    recorded = {
+        key: (size, etag)
+        for key, size, etag in models.S3Object.objects.filter(key__in=keys).values_list(
+            "key", "size", "etag"
+        )
+    }
+    for key in keys:
+        if key in recorded:
+            return key, *recorded[key]
+    for key in keys:
+        head = get_object_head_from_s3(key)
+        if head:
+            log.info(f"{key} found in s3, not in the manifest, recording it.")
+            record_object(
+                key, head["ContentLength"], head["ETag"], head["LastModified"]
+            )
+            return key, head["ContentLength"], head["ETag"].strip('"')
+    return None
+
+
+def _block_object(blockheight: int) -> Tuple[str, str, FramedObject | None]:
+    """
+    Return key and etag of the block's object, and its framed object, or None
+    if the block is archived uncompressed, or not at all
+    """
+    found = find_block_object(blockheight)
+    if found is None:
+        return f"block{blockheight}.bin", "", None
+    key, _, etag = found
+    if not key.endswith(".binz"):
+        return key, etag, None
+    return key, etag, FramedObject(key, etag)
+
+
+def read_block(blockheight: int, offset: int = 0, limit: int = -1) -> bytes:
+    """
+    Read limit bytes of the archived raw block from offset, or through the
+    end of the block if limit is -1
+    """
+    key, etag, framed_object = _block_object(blockheight)
+    if framed_object is None:
+        return read_object_from_s3(key, offset, limit, etag)
+    return b"".join(framed_object.iter(offset, limit))
+
+
+def iter_block(blockheight: int, offset: int = 0, limit: int = -1) -> Iterator[bytes]:
+    """
+    Yield limit bytes of the archived raw block from offset, or through the
+    end of the block if limit is -1, in bounded chunks
+    """
+    key, etag, framed_object = _block_object(blockheight)
+    if framed_object is None:
+        return iter_object_from_s3(key, offset, limit, etag)
+    return framed_object.iter(offset, limit)
+
+
+def get_block_size(blockheight: int) -> int | None:
+    """
+    Return size of the archived raw block, or None if it's not archived
+    """
+    found = find_block_object(blockheight)
+    if found is None:
+        return None
+    key, size, etag = found
+    if key.endswith(".binz"):
+        return FramedObject(key, etag).size
+    return size
+
+
+def get_block_json_path(blockheight: int) -> Path:
+    """
+    Return path of block's indented json, rendered from the archived block
+    on first request and cached in settings.BLOCK_JSON_CACHE_DIR. Once
+    the cache grows past settings.BLOCK_JSON_CACHE_MAX_SIZE, the least
+    recently read blocks are evicted.
+    """
+    cache_dir = Path(settings.BLOCK_JSON_CACHE_DIR)
+    path = cache_dir / f"block{blockheight}.json"
+    try:
+        os.utime(path)  # mark as recently used
+        return path
+    except FileNotFoundError:
+        pass
+    log.info(f"Rendering block {blockheight} json ...")
+    block = Block(read_block(blockheight))
+    data = json.dumps(block.dict(json_serializable=True), indent=2).encode("utf8")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+    log.info(f"Rendered block {blockheight} json.")
+
+    others = [other for other in cache_dir.glob("block*.json") if other != path]
+    target = settings.BLOCK_JSON_CACHE_MAX_SIZE - len(data)
+    if sum(other.stat().st_size for other in others) > target:
+        size = evict_lru(others, target * 0.9)
+        log.info(f"Evicted block json cache down to {size + len(data)} bytes.")
+    return path
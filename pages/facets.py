@@ -0,0 +1,162 @@
+from collections import Counter
+from typing import List
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from . import models
+
+FACETS_CACHE_KEY = "content_facets"
+
+# add counts of newly ingested content; rows are upserted in key order, so
+# concurrent ingest transactions lock the facets they share in the same order
+ADD_FACETS_SQL = """
+INSERT INTO pages_contentfacet (mime_type, mime_subtype, object_type, is_brc20, count)
+SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[], %s::boolean[], %s::bigint[])
+ON CONFLICT (mime_type, mime_subtype, object_type, is_brc20) DO UPDATE
+SET count = pages_contentfacet.count + EXCLUDED.count
+"""
+
+FACET_COLUMNS_SQL = """
+    c.mime_type,
+    COALESCE(c.mime_subtype, '') AS mime_subtype,
+    CASE
+        WHEN c.inscription_id IS NOT NULL THEN 'Inscription'
+        WHEN c.op_return_id IS NOT NULL THEN 'OpReturn'
+        ELSE 'CoinbaseScriptsig'
+    END AS object_type,
+    COALESCE(c.is_brc20, false) AS is_brc20
+"""
+
+# subtract counts of content of blocks about to be deleted
+RELEASE_FACETS_SQL = f"""
+UPDATE pages_contentfacet f SET count = f.count - d.count
+FROM (
+    SELECT {FACET_COLUMNS_SQL}, count(*) AS count
+    FROM pages_content c
+    WHERE c.block_id = ANY(%s)
+    GROUP BY 1, 2, 3, 4
+) d
+WHERE f.mime_type = d.mime_type
+    AND f.mime_subtype = d.mime_subtype
+    AND f.object_type = d.object_type
+    AND f.is_brc20 = d.is_brc20
+"""
+
+# counts of content with id in [start, end)
+COUNT_FACETS_SQL = f"""
+SELECT {FACET_COLUMNS_SQL}, count(*)
+FROM pages_content c
+WHERE c.id >= %s AND c.id < %s
+GROUP BY 1, 2, 3, 4
+"""
+
+REBUILD_FACETS_SQL = (
+    "DELETE FROM pages_contentfacet",
+    f"""
+    INSERT INTO pages_contentfacet (mime_type, mime_subtype, object_type, is_brc20, count)
+    SELECT {FACET_COLUMNS_SQL}, count(*)
+    FROM pages_content c
+    GROUP BY 1, 2, 3, 4
+    """,
+)
+
+
+def add_facets(rows: dict):
+    """
+    Add counts of content in rows from parse_block, within the transaction
+    committing them
+    """
+    add_facet_counts(
+        Counter(
+            (
+                content.mime_type,
+                content.mime_subtype or "",
+                card.object_type,
+                bool(content.is_brc20),
+            )
+            for content, card in zip(rows["contents"], rows["result_cards"])
+        )
+    )
+
+
+def add_facet_counts(counts: Counter):
+    """
+    Add counts, which may be negative, to facets within the current
+    transaction
+    Args:
+        counts: Counter, (mime_type, mime_subtype, object_type, is_brc20)
+            -> count
+    """
+    keys = sorted(key for key, count in counts.items() if count)
+    if not keys:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            ADD_FACETS_SQL,
+            [*(list(column) for column in zip(*keys)), [counts[key] for key in keys]],
+        )
+    transaction.on_commit(invalidate_facets)
+
+
+def release_facets(block_ids: List[int]):
+    """
+    Subtract counts of content of blocks with block_ids, within the
+    transaction deleting them
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(RELEASE_FACETS_SQL, [block_ids])
+    transaction.on_commit(invalidate_facets)
+
+
+def count_facets(start: int, end: int) -> Counter:
+    """
+    Count facets of content with id in [start, end)
+    Returns:
+        Counter: (mime_type, mime_subtype, object_type, is_brc20) -> count
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(COUNT_FACETS_SQL, [start, end])
+        return Counter({tuple(row[:-1]): row[-1] for row in cursor.fetchall()})
+
+
+def rebuild_facets() -> int:
+    """
+    Recount facets of all content in a single transaction
+    Returns:
+        int: number of facets
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("LOCK TABLE pages_contentfacet IN EXCLUSIVE MODE")
+        for sql in REBUILD_FACETS_SQL:
+            cursor.execute(sql)
+        facets = cursor.rowcount
+    invalidate_facets()
+    return facets
+
+
+def invalidate_facets():
+    cache.delete(FACETS_CACHE_KEY)
+
+
+def get_facets() -> List[dict]:
+    """
+    Facets with content, cached for settings.FACETS_CACHE_TIMEOUT
+    Returns:
+        List[dict]: contains keys:
+            mime_type: str
+            mime_subtype: str
+            object_type: str
+            is_brc20: bool
+            count: int
+    """
+    facets = cache.get(FACETS_CACHE_KEY)
+    if facets is None:
+        facets = list(
+            models.ContentFacet.objects.filter(count__gt=0)
+            .order_by("mime_type", "mime_subtype", "object_type", "is_brc20")
+            .values("mime_type", "mime_subtype", "object_type", "is_brc20", "count")
+        )
+        cache.set(FACETS_CACHE_KEY, facets, settings.FACETS_CACHE_TIMEOUT)
+    return facets
@@ -0,0 +1,797 @@
+import json
+import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from mimetypes import guess_extension
+from typing import Iterable, List
+
+import bits.crypto
+import requests
+from bits import constants
+from bits.blockchain import Block
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import models
+from .bitcoind import get_block_file_index
+from .blockarchive import compress_block, get_object_size, record_object
+from .facets import add_facets, release_facets
+from .mediastore import get_media_store
+from .rawblock import hash256, iter_txs, parse_header
+from .uploader import Uploader
+from .utils import parse_inscriptions, upload_to_s3
+
+log = logging.getLogger(__name__)
+
+BULK_CREATE_BATCH_SIZE = 1000
+
+# (key in parsed rows, model) in foreign key dependency order
+BULK_CREATE_ORDER = (
+    ("blocks", models.Block),
+    ("txs", models.Tx),
+    ("txins", models.TxIn),
+    ("txouts", models.TxOut),
+    ("coinbase_scriptsigs", models.CoinbaseScriptsig),
+    ("op_returns", models.OpReturn),
+    ("inscriptions", models.Inscription),
+    ("contents", models.Content),
+    ("result_cards", models.ResultCard),
+)
+
+# characters of text kept on result cards, more than fits on a card
+CARD_TEXT_LENGTH = 1024
+
+
+def parse_block(blockheight: int, raw_block: bytes) -> dict:
+    """
+    Parse block into unsaved model rows, without touching the db
+
+    Transactions are iterated lazily over the raw block buffer; only the
+    coinbase scriptsig, OP_RETURN outputs and witness elements are copied
+    out of it
+    Args:
+        blockheight: int, height of the block
+        raw_block: bytes, raw block
+    Returns:
+        dict: rows to be written by commit_block, contains keys:
+            blocks, txs, txins, txouts, coinbase_scriptsigs,
+            op_returns, inscriptions, contents, result_cards: List[models.Model]
+            media: dict, filename -> content bytes to be saved to the media store
+    """
+    rows = {key: [] for key, _ in BULK_CREATE_ORDER}
+    rows["media"] = {}
+
+    header = parse_header(raw_block)
+    block_row = models.Block(
+        blockheight=blockheight,
+        blockheaderhash=header["blockheaderhash"],
+        version=header["version"],
+        prev_blockheaderhash=header["prev_blockheaderhash"],
+        merkle_root=header["merkle_root_hash"],
+        time=header["nTime"],
+        bits=header["nBits"],
+        nonce=header["nNonce"],
+        number_of_txns=header["number_of_txns"],
+        size=len(raw_block),
+    )
+    rows["blocks"].append(block_row)
+    for txn in iter_txs(raw_block):
+        txn_n = txn.n
+        tx_row = models.Tx(
+            block=block_row,
+            n=txn_n,
+            txid=txn.txid,
+            wtxid=txn.wtxid,
+            version=txn.version,
+            locktime=txn.locktime,
+            offset=txn.offset,
+            size=txn.size,
+        )
+        rows["txs"].append(tx_row)
+        if txn_n == 0:
+            block_row.coinbase_tx = bytes(txn.raw)
+
+        txin_rows = []
+        for txin_n, (prev_txid, vout, scriptsig, sequence) in enumerate(txn.txins):
+            txin_row = models.TxIn(
+                tx=tx_row,
+                n=txin_n,
+                txid=bytes(prev_txid)[::-1].hex(),
+                vout=vout,
+                sequence=sequence,
+            )
+            txin_rows.append(txin_row)
+            # only store script sig text of coinbase tx
+            if txn_n == 0:
+                scriptsig = bytes(scriptsig)
+                coinbase_scriptsig_row = models.CoinbaseScriptsig(
+                    txin=txin_row,
+                    scriptsig=scriptsig,
+                    scriptsig_text=scriptsig.decode("utf8", "ignore").replace(
+                        "\x00", ""
+                    ),
+                )
+                rows["coinbase_scriptsigs"].append(coinbase_scriptsig_row)
+                content_row = models.Content(
+                    hash=hash256(raw_block, scriptsig),
+                    mime_type="text",
+                    params={"charset": "utf-8"},
+                    size=len(coinbase_scriptsig_row.scriptsig_text),
+                    coinbase_scriptsig=coinbase_scriptsig_row,
+                    text=coinbase_scriptsig_row.scriptsig_text,
+                    block=block_row,
+                    block_time=block_row.time,
+                    block_height=block_row.blockheight,
+                    is_brc20=False,
+                )
+                _add_content(
+                    rows,
+                    content_row,
+                    "CoinbaseScriptsig",
+                    tx_row.txid,
+                    coinbase_scriptsig_row.scriptsig_text,
+                    # header and coinbase tx, as serialized by models.Block
+                    block_binary=Block(bytes(raw_block[: txn.offset + txn.size])).bin(),
+                )
+        rows["txins"].extend(txin_rows)
+
+        for txout_n, (value, scriptpubkey) in enumerate(txn.txouts):
+            txout_row = models.TxOut(
+                tx=tx_row,
+                n=txout_n,
+                value=value,
+            )
+            rows["txouts"].append(txout_row)
+            if scriptpubkey and scriptpubkey[0] == constants.OP_RETURN:
+                scriptpubkey = bytes(scriptpubkey)
+                opreturn_row = models.OpReturn(
+                    txout=txout_row,
+                    scriptpubkey=scriptpubkey,
+                    scriptpubkey_text=scriptpubkey.decode("utf8", "ignore").replace(
+                        "\x00", ""
+                    ),
+                )
+                rows["op_returns"].append(opreturn_row)
+
+                # TODO: maybe parse OP_RETURN for more types of content, counterparty? exsat?
+                hash_preimage = (
+                    f"{block_row.blockheaderhash}:{tx_row.txid}:{txout_n}:".encode(
+                        "utf8"
+                    )
+                    + opreturn_row.scriptpubkey_text.encode("utf8")
+                )
+                content_row = models.Content(
+                    hash=bits.crypto.hash256(hash_preimage),
+                    mime_type="text",
+                    params={"charset": "utf-8"},
+                    size=len(opreturn_row.scriptpubkey_text),
+                    op_return=opreturn_row,
+                    text=opreturn_row.scriptpubkey_text,
+                    block=block_row,
+                    block_time=block_row.time,
+                    block_height=block_row.blockheight,
+                    is_brc20=False,
+                )
+                _add_content(
+                    rows,
+                    content_row,
+                    "OpReturn",
+                    tx_row.txid,
+                    opreturn_row.scriptpubkey_text,
+                )
+
+        inscription_index = 0
+        for txin_n, txin_witness_stack in enumerate(txn.witnesses):
+            for elem in txin_witness_stack:
+                try:
+                    inscriptions = parse_inscriptions(elem)
+                except ValueError as err:
+                    log.error(
+                        f"Failed to parse inscriptions in txin {txin_n} of txn {txn_n} of block {blockheight}: {err}"
+                    )
+                    continue
+                for inscription in inscriptions:
+                    inscription_id = f"{txn.txid}i{inscription_index}"
+                    inscription_index += 1
+                    _parse_inscription(
+                        rows, inscription, inscription_id, txin_rows[txin_n], block_row
+                    )
+    return rows
+
+
+def _parse_inscription(
+    rows: dict,
+    inscription: dict,
+    inscription_id: str,
+    txin_row: models.TxIn,
+    block_row: models.Block,
+):
+    content_type = inscription["content_type"]
+    content = inscription["data"]
+    content_hash = bits.crypto.hash256(content)
+    content_size = len(content)
+
+    delegate = inscription.get("delegate")
+
+    # parse content type
+    content_types = content_type.split(";")
+    mime = content_types[0].strip()
+    mime_type, mime_subtype = mime.split("/")
+    mime_params = {}
+    for param in content_types[1:]:
+        key, value = param.split("=")
+        mime_params[key.strip()] = value.strip()
+
+    filename = None
+    text = None
+    json_data = None
+    if not delegate:
+        file_ext = guess_extension(mime)
+        if not file_ext:
+            log.warning(f"Couldn't guess extension for {mime}")
+
+        charset = mime_params.get("charset", "utf-8")
+        try:
+            text = content.decode(charset)
+            json_data = json.loads(text)
+        except UnicodeDecodeError:
+            text = None
+            json_data = None
+        except json.JSONDecodeError:
+            json_data = None
+
+        if json_data and len(text) < 512:
+            # json data < 0.5kB not saved to disk
+            filename = None
+        elif mime_subtype == "html":
+            # HTML content saved to disk
+            filename = f"{content_hash.hex()}{file_ext}"
+        elif mime_type == "text" and len(text) < 512:
+            # text content < 0.5kB not saved to disk
+            filename = None
+        else:
+            # all other content saved to disk
+            filename = (
+                f"{content_hash.hex()}{file_ext}" if file_ext else content_hash.hex()
+            )
+        if filename:
+            rows["media"][filename] = content
+
+    inscription_row = models.Inscription(
+        content_hash=content_hash,
+        inscription_id=inscription_id,
+        content_type=content_type,
+        content_size=content_size,
+        mime_type=mime_type,
+        mime_subtype=mime_subtype,
+        mime_params=mime_params,
+        filename=filename,
+        text=text,
+        json=json_data,
+        delegate=delegate,
+        metadata=inscription.get("metadata"),
+        pointer=inscription.get("pointer"),
+        properties=inscription.get("properties"),
+        provenance=inscription.get("provenance"),
+        txin=txin_row,
+    )
+    rows["inscriptions"].append(inscription_row)
+
+    hash_preimage = inscription_id.encode("utf8") + b":" + content
+    if isinstance(json_data, dict):
+        is_brc20 = True if json_data.get("p") == "brc-20" else False
+    else:
+        is_brc20 = False
+    content_row = models.Content(
+        hash=bits.crypto.hash256(hash_preimage),
+        mime_type=mime_type,
+        mime_subtype=mime_subtype,
+        size=content_size,
+        params=mime_params,
+        inscription=inscription_row,
+        text=text if text else "",
+        block=block_row,
+        block_time=block_row.time,
+        block_height=block_row.blockheight,
+        is_brc20=is_brc20,
+    )
+    _add_content(
+        rows,
+        content_row,
+        "Inscription",
+        txin_row.tx.txid,
+        text,
+        filename=filename,
+        text_json=json_data if is_brc20 else None,
+    )
+
+
+def _add_content(
+    rows: dict,
+    content_row: models.Content,
+    object_type: str,
+    txid: str,
+    text: str | None,
+    filename: str = None,
+    text_json: dict = None,
+    block_binary: str = None,
+):
+    """
+    Add content row and its result card to rows
+    """
+    rows["contents"].append(content_row)
+    rows["result_cards"].append(
+        models.ResultCard(
+            content=content_row,
+            object_type=object_type,
+            txid=txid,
+            filename=filename,
+            text=text[:CARD_TEXT_LENGTH] if text is not None else None,
+            text_json=text_json,
+            block_binary=block_binary,
+        )
+    )
+
+
+def count_rows(rows: dict) -> int:
+    return sum(len(rows[key]) for key, _ in BULK_CREATE_ORDER)
+
+
+# add references held by newly inscribed media, by filename; rows are upserted
+# in filename order, so concurrent ingest transactions lock the files they
+# share in the same order
+ACQUIRE_MEDIA_SQL = """
+INSERT INTO pages_mediafile (filename, refcount)
+SELECT * FROM unnest(%s::varchar[], %s::bigint[])
+ON CONFLICT (filename) DO UPDATE
+SET refcount = pages_mediafile.refcount + EXCLUDED.refcount
+"""
+
+
+# files written for an ingest which didn't commit, which aren't referenced by
+# then; conflicting rows inserted by a concurrent ingest are waited for
+REGISTER_MEDIA_SQL = """
+INSERT INTO pages_mediafile (filename, refcount)
+SELECT unnest(%s::varchar[]), 0
+ON CONFLICT (filename) DO NOTHING
+"""
+
+
+@contextmanager
+def media_transaction(media: dict):
+    """
+    Transaction committing rows which reference media files. The files are
+    saved to the media store beforehand, skipping files it already holds. If
+    the transaction doesn't commit, files written for it are deleted again,
+    unless another ingest references them by then.
+    Args:
+        media: dict, filename -> content bytes
+    Yields:
+        List[str]: filenames written, to which files written within the
+            transaction are to be added
+    """
+    media_store = get_media_store()
+    written = [
+        filename
+        for filename, content in media.items()
+        if media_store.save(filename, content)
+    ]
+    log.debug(f"{len(written)}/{len(media)} media files written.")
+    try:
+        with transaction.atomic():
+            yield written
+    except Exception:
+        if written:
+            try:
+                discard_media(written)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                log.error(f"Failed to delete media files of rolled back ingest: {err}")
+        raise
+
+
+def discard_media(filenames: List[str]) -> int:
+    """
+    Delete files of filenames written for an ingest which didn't commit,
+    unless they're referenced
+    Returns:
+        int: number of files deleted
+    """
+    filenames = sorted(filenames)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(REGISTER_MEDIA_SQL, [filenames])
+        return delete_unreferenced_media(filenames)
+
+
+def commit_block(rows: dict, defer_search_vector: bool = False):
+    """
+    Write rows returned by parse_block to the db in a single transaction,
+    one bulk insert per model. Foreign keys are resolved from the primary keys
+    returned by each preceding insert.
+
+    With defer_search_vector, the search vector trigger leaves Content rows'
+    search_vector NULL, to be filled in batches by the searchvector command.
+
+    Media files are saved to the media store beforehand, in media_transaction,
+    and their reference counts are added with the rows, as are content facet
+    counts. Once the reference counts are acquired, files which
+    delete_unreferenced_media removed in the meantime are saved again.
+    """
+    media_store = get_media_store()
+    refcounts = Counter(
+        inscription.filename
+        for inscription in rows["inscriptions"]
+        if inscription.filename
+    )
+    with media_transaction(rows["media"]) as written:
+        if defer_search_vector:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL pages.defer_search_vector = 'on'")
+        for key, model in BULK_CREATE_ORDER:
+            model.objects.bulk_create(rows[key], batch_size=BULK_CREATE_BATCH_SIZE)
+            log.debug(f"{len(rows[key])} {model.__name__} rows saved to db.")
+        add_facets(rows)
+        if refcounts:
+            filenames = sorted(refcounts)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    ACQUIRE_MEDIA_SQL,
+                    [filenames, [refcounts[filename] for filename in filenames]],
+                )
+            # the rows are locked until commit, so files can't be deleted
+            # after this check
+            rewritten = [
+                filename
+                for filename in filenames
+                if media_store.save(filename, rows["media"][filename])
+            ]
+            if rewritten:
+                written.extend(rewritten)
+                log.info(
+                    f"{len(rewritten)} media files deleted concurrently were saved again."
+                )
+
+
+# decrement references held by inscriptions of blocks about to be deleted
+RELEASE_MEDIA_SQL = """
+UPDATE pages_mediafile m SET refcount = m.refcount - r.count
+FROM (
+    SELECT i.filename, count(*) AS count
+    FROM pages_inscription i
+    JOIN pages_txin txin ON txin.id = i.txin_id
+    JOIN pages_tx tx ON tx.id = txin.tx_id
+    WHERE tx.block_id = ANY(%s) AND i.filename IS NOT NULL
+    GROUP BY i.filename
+) r
+WHERE m.filename = r.filename
+RETURNING m.filename
+"""
+
+# locks rows in filename order, like ACQUIRE_MEDIA_SQL; refcount is checked
+# again once rows locked by a concurrent ingest are released
+LOCK_UNREFERENCED_MEDIA_SQL = """
+SELECT filename FROM pages_mediafile
+WHERE filename = ANY(%s) AND refcount <= 0
+ORDER BY filename
+FOR UPDATE
+"""
+
+
+def delete_unreferenced_media(filenames: List[str]) -> int:
+    """
+    Delete files of filenames no longer referenced by any inscription from
+    the media store. Files are deleted while their rows are locked, so an
+    ingest acquiring a reference to one waits, then saves it again.
+    Returns:
+        int: number of files deleted
+    """
+    media_store = get_media_store()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(LOCK_UNREFERENCED_MEDIA_SQL, [filenames])
+        unreferenced = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "DELETE FROM pages_mediafile WHERE filename = ANY(%s)", [unreferenced]
+        )
+        for filename in unreferenced:
+            media_store.delete(filename)
+    log.info(f"{len(unreferenced)} unreferenced media files deleted.")
+    return len(unreferenced)
+
+
+# set-based deletion of all rows of blocks, children before parents
+DELETE_BLOCKS_SQL = (
+    (
+        "ResultCard",
+        """
+        DELETE FROM pages_resultcard r USING pages_content c
+        WHERE r.content_id = c.id AND c.block_id = ANY(%s)
+        """,
+    ),
+    ("Content", "DELETE FROM pages_content WHERE block_id = ANY(%s)"),
+    (
+        "Inscription",
+        """
+        DELETE FROM pages_inscription i USING pages_txin txin, pages_tx tx
+        WHERE i.txin_id = txin.id AND txin.tx_id = tx.id AND tx.block_id = ANY(%s)
+        """,
+    ),
+    (
+        "CoinbaseScriptsig",
+        """
+        DELETE FROM pages_coinbasescriptsig c USING pages_txin txin, pages_tx tx
+        WHERE c.txin_id = txin.id AND txin.tx_id = tx.id AND tx.block_id = ANY(%s)
+        """,
+    ),
+    (
+        "OpReturn",
+        """
+        DELETE FROM pages_opreturn o USING pages_txout txout, pages_tx tx
+        WHERE o.txout_id = txout.id AND txout.tx_id = tx.id AND tx.block_id = ANY(%s)
+        """,
+    ),
+    (
+        "TxIn",
+        """
+        DELETE FROM pages_txin txin USING pages_tx tx
+        WHERE txin.tx_id = tx.id AND tx.block_id = ANY(%s)
+        """,
+    ),
+    (
+        "TxOut",
+        """
+        DELETE FROM pages_txout txout USING pages_tx tx
+        WHERE txout.tx_id = tx.id AND tx.block_id = ANY(%s)
+        """,
+    ),
+    ("Tx", "DELETE FROM pages_tx WHERE block_id = ANY(%s)"),
+    ("Block", "DELETE FROM pages_block WHERE id = ANY(%s)"),
+)
+
+
+def delete_blocks(blockheights: List[int]) -> dict:
+    """
+    Delete all db rows of blocks at blockheights in a single transaction, with
+    one DELETE statement per table rather than Django's cascading collector.
+    Media files left unreferenced are deleted once the outermost transaction
+    commits, so files re-referenced by a reindex in the same transaction are
+    kept. Does not delete s3 data.
+    Returns:
+        dict: model name -> number of rows deleted
+    """
+    deleted = {}
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM pages_block WHERE blockheight = ANY(%s)",
+            [list(blockheights)],
+        )
+        block_ids = [row[0] for row in cursor.fetchall()]
+        if not block_ids:
+            return deleted
+        cursor.execute(RELEASE_MEDIA_SQL, [block_ids])
+        released = [row[0] for row in cursor.fetchall()]
+        if released:
+            transaction.on_commit(lambda: delete_unreferenced_media(released))
+        release_facets(block_ids)
+        for model_name, sql in DELETE_BLOCKS_SQL:
+            cursor.execute(sql, [block_ids])
+            deleted[model_name] = cursor.rowcount
+    return deleted
+
+
+def fetch_block(blockheight: int, backend: str = "mempool.space") -> Block:
+    """
+    Retrieve raw block data from backend
+    """
+    if backend == "mempool.space":
+        log.info(f"Retrieving block {blockheight} from mempool.space...")
+        req = requests.get(f"https://mempool.space/api/block-height/{blockheight}")
+        req = requests.get(f"https://mempool.space/api/block/{req.text}/raw")
+        log.info(f"Retrieved block {blockheight}.")
+        return Block(req.content)
+    elif backend == "bitcoind":
+        block = Block(get_block_file_index().read_block(blockheight))
+        log.info(f"Read block {blockheight} from {settings.BITCOIND_BLOCKS_DIR}.")
+        return block
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+def get_tip_height(backend: str = "mempool.space") -> int:
+    """
+    Return height of the chain tip per backend
+    """
+    if backend == "mempool.space":
+        req = requests.get("https://mempool.space/api/blocks/tip/height")
+        return int(req.text)
+    elif backend == "bitcoind":
+        block_file_index = get_block_file_index()
+        block_file_index.update()
+        return block_file_index.height
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+def archive_block(
+    blockheight: int,
+    block: Block,
+    reupload_s3: bool = False,
+    uploader: Uploader = None,
+):
+    """
+    Upload block binary data to s3, if not already in the s3 manifest, as
+    framed and compressed block{blockheight}.binz with
+    settings.S3_BLOCK_COMPRESSION, else as block{blockheight}.bin, and record
+    it in the manifest. With uploader, the upload is queued to run in the
+    background instead. Block json is not archived, it's rendered from the
+    binary on demand by get_block_json_path.
+    """
+    if not settings.S3_BUCKET_NAME:
+        return
+    if settings.S3_BLOCK_COMPRESSION:
+        key = f"block{blockheight}.binz"
+    else:
+        key = f"block{blockheight}.bin"
+    object_exists = get_object_size(key) is not None
+    if object_exists and not reupload_s3:
+        log.info(f"{key} already exists in s3.")
+        return
+    if settings.S3_BLOCK_COMPRESSION:
+        content = compress_block(block, settings.S3_BLOCK_FRAME_SIZE)
+        log.info(
+            f"Compressed block {blockheight} from {len(block)} to {len(content)} bytes."
+        )
+    else:
+        content = block
+    if uploader is not None:
+        uploader.submit(key, content)
+        log.info(f"{key} queued for upload to s3.")
+        return
+    if not object_exists:
+        log.warning(f"{key} not found in s3.")
+        log.info(f"Uploading block {blockheight} binary data to s3...")
+        resp = upload_to_s3(key, content)
+        log.info(f"{key} uploaded to s3.")
+    else:
+        log.info(f"{key} already exists in s3.")
+        log.info(f"Reuploading block {blockheight} binary data to s3...")
+        resp = upload_to_s3(key, content)
+        log.info(f"{key} reuploaded to s3.")
+    record_object(key, len(content), resp["ETag"])
+
+
+def index_block(
+    blockheight: int,
+    backend: str = "mempool.space",
+    reupload_s3: bool = False,
+    defer_search_vector: bool = False,
+    reindex: bool = False,
+    uploader: Uploader = None,
+) -> dict:
+    """
+    Retrieve, archive, parse and save a single block. Safe to call from a
+    worker process; the block's rows are committed in one transaction.
+    With reindex, rows previously saved for the block are deleted in the
+    same transaction. With uploader, the block is archived in the background.
+    Returns:
+        dict: stats, contains keys:
+            blockheight: int
+            rows: int, number of rows saved to db
+            parse_time: float, seconds spent parsing
+            commit_time: float, seconds spent writing to db
+    """
+    block = fetch_block(blockheight, backend=backend)
+    archive_block(blockheight, block, reupload_s3=reupload_s3, uploader=uploader)
+
+    log.info(f"Parsing block {blockheight} ...")
+    parse_start = time.perf_counter()
+    rows = parse_block(blockheight, block)
+    parse_time = time.perf_counter() - parse_start
+    num_rows = count_rows(rows)
+    log.info(f"Parsed block {blockheight} into {num_rows} rows in {parse_time:.3f}s.")
+
+    commit_start = time.perf_counter()
+    with media_transaction(rows["media"]):
+        if reindex:
+            # keep edited context of content which is indexed again
+            context_revisions = {
+                bytes(content_hash): context_revision_id
+                for content_hash, context_revision_id in models.Content.objects.filter(
+                    block__blockheight=blockheight, context_revision__isnull=False
+                ).values_list("hash", "context_revision_id")
+            }
+            for content_row in rows["contents"]:
+                content_row.context_revision_id = context_revisions.get(
+                    content_row.hash
+                )
+            deleted = delete_blocks([blockheight])
+            log.info(f"Deleted block {blockheight} for reindex. {deleted}")
+        commit_block(rows, defer_search_vector=defer_search_vector)
+    commit_time = time.perf_counter() - commit_start
+    log.info(
+        f"Block {blockheight} saved to db. {num_rows} rows in {commit_time:.3f}s "
+        f"({num_rows / commit_time:.0f} rows/s, "
+        f"{num_rows / (parse_time + commit_time):.0f} rows/s incl. parsing)"
+    )
+    return {
+        "blockheight": blockheight,
+        "rows": num_rows,
+        "parse_time": parse_time,
+        "commit_time": commit_time,
+    }
+
+
+def index_blocks_pipelined(
+    blockheights: Iterable[int],
+    backend: str = "mempool.space",
+    reupload_s3: bool = False,
+    prefetch: int = 4,
+    queue_depth: int = 8,
+    uploader: Uploader = None,
+) -> int:
+    """
+    Index blocks through a staged pipeline: a pool of prefetch threads
+    retrieves and archives raw blocks ahead of the commit height, a parse
+    thread turns them into rows as they arrive, and the calling thread commits
+    them strictly in height order. At most queue_depth blocks are in flight, so
+    fetching stalls while commits catch up. With uploader, blocks are
+    archived in the background rather than by the prefetch threads.
+
+    Stops at the first block that fails, so no gaps are left behind.
+    Returns:
+        int: number of blocks committed
+    """
+
+    def fetch(blockheight: int) -> Block:
+        try:
+            block = fetch_block(blockheight, backend=backend)
+            archive_block(
+                blockheight, block, reupload_s3=reupload_s3, uploader=uploader
+            )
+            return block
+        finally:
+            # archive_block reads the s3 manifest on this thread's connection
+            connection.close()
+
+    def parse(blockheight: int, fetched) -> dict:
+        return parse_block(blockheight, fetched.result())
+
+    committed = 0
+    blockheights = iter(blockheights)
+    in_flight = deque()
+    with (
+        ThreadPoolExecutor(
+            max_workers=prefetch, thread_name_prefix="prefetch"
+        ) as fetchers,
+        ThreadPoolExecutor(max_workers=1, thread_name_prefix="parse") as parser,
+    ):
+
+        def submit() -> bool:
+            blockheight = next(blockheights, None)
+            if blockheight is None:
+                return False
+            fetched = fetchers.submit(fetch, blockheight)
+            parsed = parser.submit(parse, blockheight, fetched)
+            in_flight.append((blockheight, fetched, parsed))
+            return True
+
+        while len(in_flight) < queue_depth and submit():
+            pass
+        while in_flight:
+            blockheight, _, parsed = in_flight.popleft()
+            try:
+                rows = parsed.result()
+                commit_start = time.perf_counter()
+                commit_block(rows)
+            except Exception as err:
+                log.error(f"Failed to index block {blockheight}: {err}")
+                for _, fetched, parsed in in_flight:
+                    fetched.cancel()
+                    parsed.cancel()
+                break
+            committed += 1
+            log.info(
+                f"Block {blockheight} saved to db. {count_rows(rows)} rows in "
+                f"{time.perf_counter() - commit_start:.3f}s. "
+                f"{len(in_flight)} blocks in flight."
+            )
+            submit()
+    return committed
@@ -1,30 +1,62 @@
-import json
 import logging
-from mimetypes import guess_extension
+import multiprocessing
+import multiprocessing.util
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import requests
-import bits.crypto
-import bits.script
-from bits import constants
-from bits.tx import tx_ser
-from bits.blockchain import Block
-from django.db import transaction
-from django.conf import settings
-from django.core.management.base import BaseCommand
+from django import db
+from django.core.management.base import BaseCommand, CommandError
 
-import logging
-import pages.models
-from pages.utils import parse_inscriptions, upload_to_s3, get_object_head_from_s3
+from pages.bitcoind import get_block_file_index
+from pages.ingest import delete_blocks, index_block
+from pages.uploader import Uploader
 
 log = logging.getLogger(__name__)
 
+_uploader = None
+
+
+def init_worker():
+    """
+    Start the worker process's background uploader, drained when the worker
+    exits
+    """
+    global _uploader  # pylint: disable=global-statement
+    _uploader = Uploader()
+    multiprocessing.util.Finalize(_uploader, _uploader.close, exitpriority=10)
+
+
+def index_block_in_worker(blockheight: int, **kwargs) -> dict:
+    return index_block(blockheight, uploader=_uploader, **kwargs)
+
 
 class Command(BaseCommand):
     help = "Retrieve and index block data, parse static content"
 
     def add_arguments(self, parser):
         parser.add_argument(
-            "blockheight", type=int, help="the height of block to index"
+            "blockheight",
+            type=int,
+            nargs="?",
+            help="the height of block to index",
+        )
+        parser.add_argument(
+            "--from",
+            type=int,
+            dest="from_blockheight",
+            help="first height of block range to index (inclusive)",
+        )
+        parser.add_argument(
+            "--to",
+            type=int,
+            dest="to_blockheight",
+            help="last height of block range to index (inclusive)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of worker processes to index a block range with",
         )
         parser.add_argument(
             "--backend",
@@ -37,333 +69,142 @@ class Command(BaseCommand):
             action="store_true",
             help="reupload block data to s3",
         )
+        parser.add_argument(
+            "--defer-search-vector",
+            action="store_true",
+            help="leave search vectors of new content empty, to be filled later by the searchvector command",
+        )
         parser.add_argument(
             "--delete",
             action="store_true",
-            help="delete all db entries created for this index (note: does not delete s3 data or inscription files saved to disk)",
+            help="delete all db entries created for this index, and media files no longer referenced by any inscription (note: does not delete s3 data)",
+        )
+        parser.add_argument(
+            "--reindex",
+            action="store_true",
+            help="delete all db entries created for this index and index again, atomically",
         )
 
     def handle(
         self,
         blockheight,
         backend,
+        from_blockheight: int = None,
+        to_blockheight: int = None,
+        workers: int = 1,
         reupload_s3: bool = False,
+        defer_search_vector: bool = False,
         delete: bool = False,
+        reindex: bool = False,
         **kwargs,
     ):
+        if blockheight is not None:
+            if from_blockheight is not None or to_blockheight is not None:
+                raise CommandError("blockheight cannot be combined with --from/--to")
+            blockheights = [blockheight]
+        elif from_blockheight is not None and to_blockheight is not None:
+            if from_blockheight > to_blockheight:
+                raise CommandError("--from must not be greater than --to")
+            blockheights = list(range(from_blockheight, to_blockheight + 1))
+        else:
+            raise CommandError("either blockheight or both --from and --to required")
+        if workers < 1:
+            raise CommandError("--workers must be at least 1")
+
+        if delete and reindex:
+            raise CommandError("--delete cannot be combined with --reindex")
         if delete:
-            num_deleted, deleted_dict = pages.models.Content.objects.filter(
-                block__blockheight=blockheight
-            ).delete()
-            log.info(f"Deleted {num_deleted} entries. {deleted_dict}")
-            num_deleted, deleted_dict = pages.models.Inscription.objects.filter(
-                txin__tx__block__blockheight=blockheight
-            ).delete()
-            log.info(f"Deleted {num_deleted} entries. {deleted_dict}")
-            num_deleted, deleted_dict = pages.models.CoinbaseScriptsig.objects.filter(
-                txin__tx__block__blockheight=blockheight
-            ).delete()
-            log.info(f"Deleted {num_deleted} entries. {deleted_dict}")
-            num_deleted, deleted_dict = pages.models.OpReturn.objects.filter(
-                txout__tx__block__blockheight=blockheight
-            ).delete()
-            log.info(f"Deleted {num_deleted} entries. {deleted_dict}")
-            num_deleted, deleted_dict = pages.models.TxIn.objects.filter(
-                tx__block__blockheight=blockheight
-            ).delete()
-            log.info(f"Deleted {num_deleted} entries. {deleted_dict}")
-            num_deleted, deleted_dict = pages.models.TxOut.objects.filter(
-                tx__block__blockheight=blockheight
-            ).delete()
-            log.info(f"Deleted {num_deleted} entries. {deleted_dict}")
-            num_deleted, deleted_dict = pages.models.Tx.objects.filter(
-                block__blockheight=blockheight
-            ).delete()
-            log.info(f"Deleted {num_deleted} entries. {deleted_dict}")
-            num_deleted, deleted_dict = pages.models.Block.objects.filter(
-                blockheight=blockheight
-            ).delete()
-            log.info(f"Deleted {num_deleted} entries. {deleted_dict}")
+            deleted = delete_blocks(blockheights)
+            log.info(f"Deleted {sum(deleted.values())} entries. {deleted}")
             return
-        if backend == "mempool.space":
-            log.info(f"Retrieving block {blockheight} from mempool.space...")
-            req = requests.get(f"https://mempool.space/api/block-height/{blockheight}")
-            req = requests.get(f"https://mempool.space/api/block/{req.text}/raw")
-            log.info(f"Retrieved block {blockheight}.")
-            block = Block(req.content)
 
-            if settings.S3_BUCKET_NAME:
-                object_exists = get_object_head_from_s3(f"block{blockheight}.bin")
-                if not object_exists:
-                    log.warning(f"block{blockheight}.bin not found in s3.")
-                    log.info(f"Uploading block {blockheight} binary data to s3...")
-                    resp = upload_to_s3(f"block{blockheight}.bin", block)
-                    log.info(f"block{blockheight}.bin uploaded to s3.")
-                elif reupload_s3:
-                    log.info(f"block{blockheight}.bin already exists in s3.")
-                    log.info(f"Reuploading block {blockheight} binary data to s3...")
-                    resp = upload_to_s3(f"block{blockheight}.bin", block)
-                    log.info(f"block{blockheight}.bin reuploaded to s3.")
-                else:
-                    log.info(f"block{blockheight}.bin already exists in s3.")
-
-            log.info(f"Deserializing block {blockheight} ...")
-            block_json_data = json.dumps(block.dict(json_serializable=True), indent=2)
-            log.info(f"Deserialized block {blockheight}.")
-            if settings.S3_BUCKET_NAME:
-                object_exists = get_object_head_from_s3(f"block{blockheight}.json")
-                if not object_exists:
-                    log.warning(f"block{blockheight}.json not found in s3.")
-                    log.info(f"Uploading block {blockheight} json data to s3...")
-                    resp = upload_to_s3(f"block{blockheight}.json", block_json_data)
-                    log.info(f"block{blockheight}.json uploaded to s3.")
-                elif reupload_s3:
-                    log.info(f"block{blockheight}.json already exists in s3.")
-                    log.info(f"Reuploading block {blockheight} json data to s3...")
-                    resp = upload_to_s3(f"block{blockheight}.json", block_json_data)
-                    log.info(f"block{blockheight}.json reuploaded to s3.")
-                else:
-                    log.info(f"block{blockheight}.json already exists in s3.")
-
-            with transaction.atomic():
-                block_row = pages.models.Block(
-                    blockheight=blockheight,
-                    blockheaderhash=block["blockheaderhash"],
-                    version=block["version"],
-                    prev_blockheaderhash=block["prev_blockheaderhash"],
-                    merkle_root=block["merkle_root_hash"],
-                    time=block["nTime"],
-                    bits=block["nBits"],
-                    nonce=block["nNonce"],
-                    coinbase_tx=tx_ser(block["txns"][0]),
-                    number_of_txns=len(block["txns"]),
+        if backend == "bitcoind":
+            # build or extend the block file index once, before any workers fork
+            block_file_index = get_block_file_index()
+            if blockheights[-1] > block_file_index.height:
+                block_file_index.update()
+
+        with Uploader() as uploader:
+            retried = uploader.retry_spooled()
+            if retried:
+                log.info(f"Retrying {retried} uploads left from previous runs.")
+
+        if len(blockheights) == 1:
+            with Uploader() as uploader:
+                index_block(
+                    blockheights[0],
+                    backend=backend,
+                    reupload_s3=reupload_s3,
+                    defer_search_vector=defer_search_vector,
+                    reindex=reindex,
+                    uploader=uploader,
                 )
-                block_row.save()
-                log.info(f"{block_row} saved to db.")
-                for txn_n, txn in enumerate(block["txns"]):
-                    tx_row = pages.models.Tx(
-                        block=block_row,
-                        n=txn_n,
-                        txid=txn["txid"],
-                        wtxid=txn["wtxid"],
-                        version=txn["version"],
-                        locktime=txn["locktime"],
-                    )
-                    tx_row.save()
-                    log.info(f"{tx_row} saved to db.")
-                    for txin_n, txin in enumerate(txn["txins"]):
-                        txin_row = pages.models.TxIn(
-                            tx=tx_row,
-                            n=txin_n,
-                            txid=txin["txid"],
-                            vout=txin["vout"],
-                            sequence=txin["sequence"],
-                        )
-                        txin_row.save()
-                        log.info(f"{txin_row} saved to db.")
-                        # only store script sig text of coinbase tx
-                        if txn_n == 0:
-                            coinbase_scriptsig_row = pages.models.CoinbaseScriptsig(
-                                txin=txin_row,
-                                scriptsig=bytes.fromhex(txin["scriptsig"]),
-                                scriptsig_text=bytes.fromhex(txin["scriptsig"])
-                                .decode("utf8", "ignore")
-                                .replace("\x00", ""),
-                            )
-                            coinbase_scriptsig_row.save()
-                            log.info(f"{coinbase_scriptsig_row} saved to db.")
-
-                            content_row = pages.models.Content(
-                                hash=bits.crypto.hash256(
-                                    block + coinbase_scriptsig_row.scriptsig
-                                ),
-                                mime_type="text",
-                                params={"charset": "utf-8"},
-                                size=len(coinbase_scriptsig_row.scriptsig_text),
-                                coinbase_scriptsig=coinbase_scriptsig_row,
-                                text=coinbase_scriptsig_row.scriptsig_text,
-                                block=block_row,
-                                block_time=block_row.time,
-                                block_height=block_row.blockheight,
-                                is_brc20=False,
-                            )
-                            content_row.save()
-                            log.info(f"{content_row} saved to db.")
-
-                    for txout_n, txout in enumerate(txn["txouts"]):
-                        txout_row = pages.models.TxOut(
-                            tx=tx_row,
-                            n=txout_n,
-                            value=txout["value"],
-                        )
-                        txout_row.save()
-                        log.info(f"{txout_row} saved to db.")
-                        if (
-                            bytes.fromhex(txout["scriptpubkey"])[0]
-                            == constants.OP_RETURN
-                        ):
-                            opreturn_row = pages.models.OpReturn(
-                                txout=txout_row,
-                                scriptpubkey=bytes.fromhex(txout["scriptpubkey"]),
-                                scriptpubkey_text=bytes.fromhex(txout["scriptpubkey"])
-                                .decode("utf8", "ignore")
-                                .replace("\x00", ""),
-                            )
-                            opreturn_row.save()
-                            log.info(f"{opreturn_row} saved to db.")
-
-                            # TODO: maybe parse OP_RETURN for more types of content, counterparty? exsat?
-                            hash_preimage = f"{opreturn_row.txout.tx.block.blockheaderhash}:{opreturn_row.txout.tx.txid}:{opreturn_row.txout.n}:".encode(
-                                "utf8"
-                            ) + opreturn_row.scriptpubkey_text.encode(
-                                "utf8"
-                            )
-                            content_row = pages.models.Content(
-                                hash=bits.crypto.hash256(hash_preimage),
-                                mime_type="text",
-                                params={"charset": "utf-8"},
-                                size=len(opreturn_row.scriptpubkey_text),
-                                op_return=opreturn_row,
-                                text=opreturn_row.scriptpubkey_text,
-                                block=block_row,
-                                block_time=block_row.time,
-                                block_height=block_row.blockheight,
-                                is_brc20=False,
-                            )
-                            content_row.save()
-                            log.info(f"{content_row} saved to db.")
-
-                    inscription_index = 0
-                    for txin_n, txin_witness_stack in enumerate(
-                        txn.get("witnesses", [])
-                    ):
-                        log.info(
-                            f"Parsing witness of txin {txin_n} of txn {txn_n} of block {blockheight}..."
-                        )
-                        for elem_i, elem in enumerate(txin_witness_stack):
-                            try:
-                                inscriptions = parse_inscriptions(elem)
-                            except ValueError as err:
-                                log.error(f"Failed to parse inscriptions: {err}")
-                                continue
-                            for inscription in inscriptions:
-                                content_type = inscription["content_type"]
-                                content = inscription["data"]
-                                content_hash = bits.crypto.hash256(content)
-                                content_size = len(content)
-
-                                delegate = inscription.get("delegate")
-                                metadata = inscription.get("metadata")
-                                pointer = inscription.get("pointer")
-                                properties = inscription.get("properties")
-                                provenance = inscription.get("provenance")
-
-                                # parse content type
-                                content_types = content_type.split(";")
-                                mime = content_types[0].strip()
-                                mime_type, mime_subtype = mime.split("/")
-                                mime_params = {}
-                                for param in content_types[1:]:
-                                    key, value = param.split("=")
-                                    mime_params[key.strip()] = value.strip()
-
-                                if not delegate:
-                                    file_ext = guess_extension(mime)
-                                    if not file_ext:
-                                        log.warning(
-                                            f"Couldn't guess extension for {mime}"
-                                        )
-
-                                    charset = mime_params.get("charset", "utf-8")
-                                    try:
-                                        text = content.decode(charset)
-                                        json_data = json.loads(text)
-                                    except UnicodeDecodeError:
-                                        text = None
-                                        json_data = None
-                                    except json.JSONDecodeError:
-                                        json_data = None
-
-                                    if json_data and len(text) < 512:
-                                        # json data < 0.5kB not saved to disk
-                                        filename = None
-                                    elif mime_subtype == "html":
-                                        # HTML content saved to disk
-                                        filename = f"{content_hash.hex()}{file_ext}"
-                                    elif mime_type == "text" and len(text) < 512:
-                                        # text content < 0.5kB not saved to disk
-                                        filename = None
-                                    else:
-                                        # all other content saved to disk
-                                        filename = (
-                                            f"{content_hash.hex()}{file_ext}"
-                                            if file_ext
-                                            else content_hash.hex()
-                                        )
-                                    if filename:
-                                        filepath = settings.MEDIA_ROOT / filename
-                                        with filepath.open("wb") as fp:
-                                            fp.write(content)
-                                        log.info(
-                                            f"{filename} saved to {settings.MEDIA_ROOT}"
-                                        )
-
-                                inscription_id = f"{txn['txid']}i{inscription_index}"
-                                inscription_index += 1
-                                inscription_row = pages.models.Inscription(
-                                    content_hash=content_hash,
-                                    inscription_id=inscription_id,
-                                    content_type=content_type,
-                                    content_size=content_size,
-                                    mime_type=mime_type,
-                                    mime_subtype=mime_subtype,
-                                    mime_params=mime_params,
-                                    filename=filename,
-                                    text=text,
-                                    json=json_data,
-                                    delegate=delegate,
-                                    metadata=metadata,
-                                    pointer=pointer,
-                                    properties=properties,
-                                    provenance=provenance,
-                                    txin=pages.models.TxIn.objects.get(
-                                        tx=tx_row, n=txin_n
-                                    ),
-                                )
-                                inscription_row.save()
-                                log.info(f"{inscription_row} saved to db.")
-
-                                hash_preimage = (
-                                    inscription_row.inscription_id.encode("utf8")
-                                    + b":"
-                                    + content
-                                )
-                                if isinstance(json_data, dict):
-                                    is_brc20 = (
-                                        True
-                                        if json_data.get("p") == "brc-20"
-                                        else False
-                                    )
-                                else:
-                                    is_brc20 = False
-                                content_row = pages.models.Content(
-                                    hash=bits.crypto.hash256(hash_preimage),
-                                    mime_type=mime_type,
-                                    mime_subtype=mime_subtype,
-                                    size=content_size,
-                                    params=mime_params,
-                                    inscription=inscription_row,
-                                    text=(
-                                        inscription_row.text
-                                        if inscription_row.text
-                                        else ""
-                                    ),
-                                    block=block_row,
-                                    block_time=block_row.time,
-                                    block_height=block_row.blockheight,
-                                    is_brc20=is_brc20,
-                                )
-                                content_row.save()
-                                log.info(f"{content_row} saved to db.")
-        elif backend == "bitcoind":
-            raise NotImplementedError
+        else:
+            self.index_range(
+                blockheights,
+                backend,
+                reupload_s3=reupload_s3,
+                defer_search_vector=defer_search_vector,
+                reindex=reindex,
+                workers=workers,
+            )
+
+    def index_range(
+        self,
+        blockheights: list,
+        backend: str,
+        reupload_s3: bool = False,
+        defer_search_vector: bool = False,
+        reindex: bool = False,
+        workers: int = 1,
+    ):
+        """
+        Index blocks in a pool of worker processes. Each worker retrieves,
+        parses and commits its blocks on its own db connection, one
+        transaction per block, so blocks may be committed out of order, and
+        archives them to s3 in the background.
+        """
+        total = len(blockheights)
+        done = 0
+        failed = []
+        total_rows = 0
+        start = time.perf_counter()
+        # connections must not be shared with forked workers
+        db.connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker,
+        ) as executor:
+            futures = {
+                executor.submit(
+                    index_block_in_worker,
+                    blockheight,
+                    backend=backend,
+                    reupload_s3=reupload_s3,
+                    defer_search_vector=defer_search_vector,
+                    reindex=reindex,
+                ): blockheight
+                for blockheight in blockheights
+            }
+            for future in as_completed(futures):
+                blockheight = futures[future]
+                done += 1
+                try:
+                    stats = future.result()
+                except Exception as err:
+                    failed.append(blockheight)
+                    log.error(f"Failed to index block {blockheight}: {err}")
+                    continue
+                total_rows += stats["rows"]
+                elapsed = time.perf_counter() - start
+                log.info(
+                    f"Indexed block {blockheight}. {done}/{total} ({done/total*100:.2f}%) "
+                    f"{done / elapsed:.2f} blocks/s, {total_rows / elapsed:.0f} rows/s"
+                )
+        log.info(
+            f"Indexed {total - len(failed)}/{total} blocks in "
+            f"{time.perf_counter() - start:.1f}s with {workers} workers."
+        )
+        if failed:
+            raise CommandError(f"Failed to index blocks: {sorted(failed)}")
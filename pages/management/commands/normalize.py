@@ -1,46 +1,180 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from django import db
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from pages.models import Content
+from pages.facets import add_facet_counts, count_facets
 
 log = logging.getLogger(__name__)
 
+# only touches rows that need it, and never the text column, so the search
+# vector trigger doesn't fire
+NORMALIZE_FIELDS_SQL = """
+UPDATE pages_content c SET
+    block_time = CASE
+        WHEN c.block_time IS NULL OR c.block_time = 0 THEN b.time
+        ELSE c.block_time
+    END,
+    block_height = CASE
+        WHEN c.block_height IS NULL OR c.block_height = 0 THEN b.blockheight
+        ELSE c.block_height
+    END,
+    is_brc20 = COALESCE(
+        c.is_brc20,
+        (
+            SELECT i.json ->> 'p' = 'brc-20'
+            FROM pages_inscription i
+            WHERE i.id = c.inscription_id
+        ),
+        false
+    ),
+    mime_type = split_part(c.mime_type, '/', 1),
+    mime_subtype = CASE
+        WHEN strpos(c.mime_type, '/') > 0 THEN split_part(c.mime_type, '/', 2)
+        ELSE c.mime_subtype
+    END
+FROM pages_block b
+WHERE b.id = c.block_id
+    AND c.id >= %(start)s AND c.id < %(end)s
+    AND (
+        c.block_time IS NULL OR c.block_time = 0
+        OR c.block_height IS NULL OR c.block_height = 0
+        OR c.is_brc20 IS NULL
+        OR strpos(c.mime_type, '/') > 0
+    )
+"""
+
+# text is only written where it changes, so search vectors are recomputed
+# only for those rows
+NORMALIZE_TEXT_SQL = """
+UPDATE pages_content c SET text = t.text
+FROM (
+    SELECT c2.id, COALESCE(
+        CASE
+            WHEN c2.inscription_id IS NOT NULL THEN i.text
+            WHEN c2.coinbase_scriptsig_id IS NOT NULL THEN cs.scriptsig_text
+            WHEN c2.op_return_id IS NOT NULL THEN o.scriptpubkey_text
+        END,
+        ''
+    ) AS text
+    FROM pages_content c2
+    LEFT JOIN pages_inscription i ON i.id = c2.inscription_id
+    LEFT JOIN pages_coinbasescriptsig cs ON cs.id = c2.coinbase_scriptsig_id
+    LEFT JOIN pages_opreturn o ON o.id = c2.op_return_id
+    WHERE c2.id >= %(start)s AND c2.id < %(end)s
+) t
+WHERE c.id = t.id AND c.text IS DISTINCT FROM t.text
+"""
+
+
+def normalize_chunk(start: int, end: int) -> int:
+    """
+    Normalize content with id in [start, end) in a single transaction, moving
+    the counts of rewritten rows between content facets in it
+    Returns:
+        int: number of rows updated
+    """
+    try:
+        with db.transaction.atomic(), db.connection.cursor() as cursor:
+            params = {"start": start, "end": end}
+            facets = count_facets(start, end)
+            cursor.execute(NORMALIZE_FIELDS_SQL, params)
+            updated = cursor.rowcount
+            if updated:
+                counts = count_facets(start, end)
+                counts.subtract(facets)
+                add_facet_counts(counts)
+            cursor.execute(NORMALIZE_TEXT_SQL, params)
+            return updated + cursor.rowcount
+    finally:
+        db.connection.close()
+
 
 class Command(BaseCommand):
     help = "Normalize content"
 
-    def handle(self, *args, **options):
-        log.info("counting content objects...")
-        count = Content.objects.count()
-        log.info(f"found {count} Content objects.")
-        contents = Content.objects.order_by("id").all()
-        for i, content in enumerate(contents.iterator(), start=1):
-            log.info(f"normalizing {content} ...")
-            if not content.block_time:
-                content.block_time = content.block.time
-            if not content.block_height:
-                content.block_height = content.block.blockheight
-            if content.inscription is not None:
-                text = content.inscription.text
-                if isinstance(content.inscription.json, dict):
-                    is_brc20 = (
-                        True if content.inscription.json.get("p") == "brc-20" else False
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="number of content ids normalized per transaction",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of chunks normalized concurrently",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            type=Path,
+            default=settings.BASE_DIR / "normalize.checkpoint",
+            help="file where the id below which all content is normalized is saved, to resume from",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="ignore the checkpoint and normalize from the first content id",
+        )
+
+    def handle(
+        self,
+        chunk_size: int = 10000,
+        workers: int = 1,
+        checkpoint: Path = None,
+        restart: bool = False,
+        **kwargs,
+    ):
+        with db.connection.cursor() as cursor:
+            cursor.execute("SELECT min(id), max(id) FROM pages_content")
+            min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            log.info("no Content objects found.")
+            return
+
+        start_id = min_id
+        if not restart and checkpoint.exists():
+            start_id = max(min_id, int(checkpoint.read_text()))
+            log.info(f"resuming from checkpoint at id {start_id}.")
+        chunks = list(range(start_id, max_id + 1, chunk_size))
+        log.info(
+            f"normalizing Content objects with id {start_id}-{max_id} "
+            f"in {len(chunks)} chunks..."
+        )
+
+        # chunks complete out of order with several workers; the checkpoint
+        # only advances past chunks which are all done
+        next_chunk = 0
+        done = set()
+        updated = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(normalize_chunk, chunk, chunk + chunk_size): chunk
+                for chunk in chunks
+            }
+            for i, future in enumerate(as_completed(futures), start=1):
+                chunk = futures[future]
+                try:
+                    updated += future.result()
+                except Exception as err:
+                    log.error(
+                        f"Failed to normalize ids {chunk}-{chunk + chunk_size - 1}: {err}"
                     )
-                else:
-                    is_brc20 = False
-            elif content.coinbase_scriptsig is not None:
-                text = content.coinbase_scriptsig.scriptsig_text
-                is_brc20 = False
-            elif content.op_return is not None:
-                text = content.op_return.scriptpubkey_text
-                is_brc20 = False
-            if text is None:
-                text = ""
-            content.text = text
-            if content.is_brc20 is None:
-                content.is_brc20 = is_brc20
-            if "/" in content.mime_type:
-                content.mime_type, content.mime_subtype = content.mime_type.split("/")
-            content.save()
-            log.info(f"{content} normalized. {i}/{count} ({i/count*100:.2f}%)")
-            # del content
+                    continue
+                done.add(chunk)
+                if chunks[next_chunk] in done:
+                    while next_chunk < len(chunks) and chunks[next_chunk] in done:
+                        done.remove(chunks[next_chunk])
+                        next_chunk += 1
+                    checkpoint.write_text(str(chunks[next_chunk - 1] + chunk_size))
+                log.info(
+                    f"normalized ids {chunk}-{chunk + chunk_size - 1}. "
+                    f"{i}/{len(chunks)} ({i/len(chunks)*100:.2f}%) "
+                    f"{updated} rows updated in {time.perf_counter() - start:.1f}s"
+                )
@@ -0,0 +1,38 @@
+import logging
+import time
+
+from django import db
+from django.core.management.base import BaseCommand
+
+from pages.blockarchive import sync_manifest
+
+log = logging.getLogger(__name__)
+
+# block sizes of blocks indexed before they were recorded, from uncompressed
+# objects; sizes of compressed blocks are read from their frame header
+BACKFILL_BLOCK_SIZE_SQL = """
+UPDATE pages_block b SET size = o.size
+FROM pages_s3object o
+WHERE b.size IS NULL AND o.key = 'block' || b.blockheight || '.bin'
+"""
+
+
+class Command(BaseCommand):
+    help = "Sync the local manifest of archived s3 objects from bucket listings"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--prefix",
+            default="block",
+            help="only list objects with keys starting with prefix",
+        )
+
+    def handle(self, prefix: str = "block", **kwargs):
+        start = time.perf_counter()
+        listed = sync_manifest(prefix)
+        log.info(
+            f"{listed} objects synced to manifest in {time.perf_counter() - start:.1f}s"
+        )
+        with db.connection.cursor() as cursor:
+            cursor.execute(BACKFILL_BLOCK_SIZE_SQL)
+            log.info(f"Block size backfilled for {cursor.rowcount} blocks.")
@@ -0,0 +1,156 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django import db
+from django.core.management.base import BaseCommand
+
+log = logging.getLogger(__name__)
+
+PENDING_RANGES_SQL = """
+SELECT block_height / %s AS bucket, count(*)
+FROM pages_content
+WHERE search_vector IS NULL
+GROUP BY bucket
+ORDER BY bucket
+"""
+
+UPDATE_RANGE_SQL = """
+UPDATE pages_content
+SET search_vector = to_tsvector('english', COALESCE(text, ''))
+WHERE search_vector IS NULL AND block_height >= %s AND block_height < %s
+"""
+
+UPDATE_NULL_HEIGHT_SQL = """
+UPDATE pages_content
+SET search_vector = to_tsvector('english', COALESCE(text, ''))
+WHERE search_vector IS NULL AND block_height IS NULL
+"""
+
+
+def pending_ranges(batch_size: int, start: int = None, end: int = None) -> list:
+    """
+    Block height ranges with content still missing a search vector
+    Returns:
+        List[tuple]: (first height, last height + 1, pending rows), with
+            (None, None, pending rows) for rows without a block height
+    """
+    with db.connection.cursor() as cursor:
+        cursor.execute(PENDING_RANGES_SQL, [batch_size])
+        rows = cursor.fetchall()
+    ranges = []
+    for bucket, count in rows:
+        if bucket is None:
+            ranges.append((None, None, count))
+            continue
+        range_start = bucket * batch_size
+        range_end = range_start + batch_size
+        if start is not None:
+            range_start = max(range_start, start)
+        if end is not None:
+            range_end = min(range_end, end + 1)
+        if range_start < range_end:
+            ranges.append((range_start, range_end, count))
+    return ranges
+
+
+def update_range(range_start: int, range_end: int) -> int:
+    """
+    Fill search vectors in block height range [range_start, range_end) in a
+    single UPDATE. Runs in its own transaction.
+    """
+    try:
+        with db.connection.cursor() as cursor:
+            if range_start is None:
+                cursor.execute(UPDATE_NULL_HEIGHT_SQL)
+            else:
+                cursor.execute(UPDATE_RANGE_SQL, [range_start, range_end])
+            return cursor.rowcount
+    finally:
+        db.connection.close()
+
+
+class Command(BaseCommand):
+    help = "Fill search vectors of content ingested with --defer-search-vector"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--from",
+            type=int,
+            dest="from_blockheight",
+            help="first block height to fill (inclusive)",
+        )
+        parser.add_argument(
+            "--to",
+            type=int,
+            dest="to_blockheight",
+            help="last block height to fill (inclusive)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="number of block heights updated per statement",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of block height ranges updated concurrently",
+        )
+        parser.add_argument(
+            "--status",
+            action="store_true",
+            help="only report block height ranges still pending",
+        )
+
+    def handle(
+        self,
+        from_blockheight: int = None,
+        to_blockheight: int = None,
+        batch_size: int = 100,
+        workers: int = 1,
+        status: bool = False,
+        **kwargs,
+    ):
+        ranges = pending_ranges(batch_size, from_blockheight, to_blockheight)
+        if from_blockheight is not None or to_blockheight is not None:
+            # rows without a block height can't be attributed to the range
+            ranges = [range_ for range_ in ranges if range_[0] is not None]
+        total = sum(count for _, _, count in ranges)
+        log.info(f"{total} content rows pending search vector in {len(ranges)} ranges.")
+        if status:
+            for range_start, range_end, count in ranges:
+                if range_start is None:
+                    log.info(f"no block height: {count} pending")
+                else:
+                    log.info(f"{range_start}-{range_end - 1}: {count} pending")
+            return
+        if not ranges:
+            return
+
+        done = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(update_range, range_start, range_end): (
+                    range_start,
+                    range_end,
+                )
+                for range_start, range_end, _ in ranges
+            }
+            for future in as_completed(futures):
+                range_start, range_end = futures[future]
+                try:
+                    updated = future.result()
+                except Exception as err:
+                    log.error(
+                        f"Failed to fill search vectors for {range_start}-{range_end}: {err}"
+                    )
+                    continue
+                done += updated
+                elapsed = time.perf_counter() - start
+                log.info(
+                    f"Filled {updated} search vectors for {range_start}-{range_end}. "
+                    f"{done}/{total} ({done/total*100:.2f}%) {done / elapsed:.0f} rows/s"
+                )
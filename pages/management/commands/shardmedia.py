@@ -0,0 +1,55 @@
+import logging
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from pages.mediastore import get_media_store
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Move media files saved flat in MEDIA_ROOT into media store shards"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only count files which would be moved",
+        )
+
+    def handle(self, dry_run: bool = False, **kwargs):
+        media_store = get_media_store()
+        moved = 0
+        duplicates = 0
+        start = time.perf_counter()
+        # scandir streams entries, rather than listing millions of files at once
+        with os.scandir(media_store.root) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                if dry_run:
+                    moved += 1
+                    continue
+                path = media_store.path(entry.name)
+                if path.exists():
+                    # identical content, named by its hash
+                    os.unlink(entry.path)
+                    duplicates += 1
+                    continue
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(entry.path, path)
+                moved += 1
+                if moved % 10000 == 0:
+                    log.info(
+                        f"{moved} media files moved in "
+                        f"{time.perf_counter() - start:.1f}s"
+                    )
+        if dry_run:
+            log.info(f"{moved} media files to move.")
+            return
+        log.info(
+            f"{moved} media files moved, {duplicates} duplicates removed in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
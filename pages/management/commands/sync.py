@@ -1,11 +1,11 @@
 import logging
 import time
 
-import requests
-from django.core.management.base import BaseCommand
-from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
 
+from pages.ingest import get_tip_height, index_blocks_pipelined
 from pages.models import Block
+from pages.uploader import Uploader
 
 
 log = logging.getLogger(__name__)
@@ -14,31 +14,96 @@ log = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = "Sync with blockchain"
 
-    def handle(self, *args, **options):
-        current_blockheight = Block.objects.order_by("-blockheight").first().blockheight
-        req = requests.get(f"https://mempool.space/api/blocks/tip/height")
-        mempool_blockheight = int(req.text)
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backend",
+            choices=["mempool.space", "bitcoind"],
+            default="mempool.space",
+            help="backend to use for retrieving raw block data to be parsed and indexed",
+        )
+        parser.add_argument(
+            "--prefetch",
+            type=int,
+            default=4,
+            help="number of threads retrieving blocks ahead of the committed height",
+        )
+        parser.add_argument(
+            "--queue-depth",
+            type=int,
+            default=8,
+            help="maximum number of blocks retrieved or parsed but not yet committed",
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=60,
+            help="seconds to sleep between polls for new blocks",
+        )
+        parser.add_argument(
+            "--retry-every",
+            type=int,
+            default=100,
+            help="number of blocks indexed between retries of failed uploads",
+        )
 
-        if current_blockheight < mempool_blockheight:
-            for blockheight in range(current_blockheight + 1, mempool_blockheight + 1):
-                log.info(f"Indexing block {blockheight}...")
-                try:
-                    call_command("index", blockheight, reupload_s3=True)
-                except Exception as e:
-                    log.error(f"Failed to index block {blockheight}: {e}")
+    def handle(
+        self,
+        backend: str = "mempool.space",
+        prefetch: int = 4,
+        queue_depth: int = 8,
+        interval: int = 60,
+        retry_every: int = 100,
+        **kwargs,
+    ):
+        if prefetch < 1:
+            raise CommandError("--prefetch must be at least 1")
+        if queue_depth < 1:
+            raise CommandError("--queue-depth must be at least 1")
+        if retry_every < 1:
+            raise CommandError("--retry-every must be at least 1")
+        with Uploader() as uploader:
+            self.sync(backend, prefetch, queue_depth, interval, retry_every, uploader)
 
+    def sync(
+        self,
+        backend: str,
+        prefetch: int,
+        queue_depth: int,
+        interval: int,
+        retry_every: int,
+        uploader: Uploader,
+    ):
         while True:
-            req = requests.get(f"https://mempool.space/api/blocks/tip/height")
-            blockchain_height = int(req.text)
-            log.info(f"Blockchain height per mempool.space: {blockchain_height}")
+            blockchain_height = get_tip_height(backend)
+            log.info(f"Blockchain height per {backend}: {blockchain_height}")
             current_blockheight = (
                 Block.objects.order_by("-blockheight").first().blockheight
             )
             log.info(f"Local blockchain height: {current_blockheight}")
-            if current_blockheight < blockchain_height:
-                try:
-                    call_command("index", blockchain_height, reupload_s3=True)
-                except Exception as e:
-                    log.error(f"Failed to index block {blockchain_height}: {e}")
-            log.info("Sleeping for 60 seconds...")
-            time.sleep(60)
+            # index in batches of retry_every blocks, retrying failed uploads
+            # before each, so they are not left in the spool while catching up.
+            # A batch stops at the first block that fails, which the next poll
+            # retries from, so later batches are not indexed past the gap
+            for start in range(
+                current_blockheight + 1, blockchain_height + 1, retry_every
+            ):
+                self.retry_uploads(uploader)
+                batch = range(start, min(start + retry_every, blockchain_height + 1))
+                committed = index_blocks_pipelined(
+                    batch,
+                    backend=backend,
+                    reupload_s3=True,
+                    prefetch=prefetch,
+                    queue_depth=queue_depth,
+                    uploader=uploader,
+                )
+                if committed < len(batch):
+                    break
+            self.retry_uploads(uploader)
+            log.info(f"Sleeping for {interval} seconds...")
+            time.sleep(interval)
+
+    def retry_uploads(self, uploader: Uploader):
+        retried = uploader.retry_spooled()
+        if retried:
+            log.info(f"Retrying {retried} failed uploads.")
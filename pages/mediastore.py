@@ -0,0 +1,74 @@
+import logging
+import os
+import threading
+from pathlib import Path
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+class MediaStore:
+    """
+    Content-addressed media files under root
+
+    Files are named by content hash and sharded two directory levels deep by
+    hash prefix (ab/cd/abcd...), keeping directories small at tens of millions
+    of files. Files are written once, atomically, and never rewritten; the
+    number of inscriptions referencing each file is kept in MediaFile rows.
+    """
+
+    def __init__(self, root: Path | str):
+        self.root = Path(root)
+
+    def relative_path(self, filename: str) -> str:
+        return f"{filename[:2]}/{filename[2:4]}/{filename}"
+
+    def path(self, filename: str) -> Path:
+        return self.root / self.relative_path(filename)
+
+    def find(self, filename: str) -> Path | None:
+        """
+        Return path of filename, in its shard or, if not migrated yet, in the
+        flat root directory, or None if it doesn't exist
+        """
+        for path in (self.path(filename), self.root / filename):
+            if path.is_file():
+                return path
+        return None
+
+    def exists(self, filename: str) -> bool:
+        return self.path(filename).exists()
+
+    def save(self, filename: str, content: bytes) -> bool:
+        """
+        Write content to filename, unless it already exists, through a temp
+        file renamed into place
+        Returns:
+            bool: whether the file was written
+        """
+        path = self.path(filename)
+        if path.exists():
+            return False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{filename}.{os.getpid()}.{threading.get_ident()}")
+        tmp_path.write_bytes(content)
+        tmp_path.replace(path)
+        return True
+
+    def delete(self, filename: str):
+        for path in (self.path(filename), self.root / filename):
+            path.unlink(missing_ok=True)
+
+
+_media_store = None
+
+
+def get_media_store() -> MediaStore:
+    """
+    Return MediaStore for settings.MEDIA_ROOT
+    """
+    global _media_store  # pylint: disable=global-statement
+    if _media_store is None:
+        _media_store = MediaStore(settings.MEDIA_ROOT)
+    return _media_store
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0007_content_content_bh_mime_idx_and_more"),
+    ]
+
+    operations = [
+        # Skip computing the search vector on insert when the session has set
+        # pages.defer_search_vector, leaving it NULL for the searchvector command
+        migrations.RunSQL(
+            sql="""
+            CREATE OR REPLACE FUNCTION pages_content_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT'
+                    AND current_setting('pages.defer_search_vector', true) = 'on' THEN
+                    NEW.search_vector := NULL;
+                    RETURN NEW;
+                END IF;
+                NEW.search_vector := to_tsvector('english', COALESCE(NEW.text, ''));
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            reverse_sql="""
+            CREATE OR REPLACE FUNCTION pages_content_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := to_tsvector('english', COALESCE(NEW.text, ''));
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+        ),
+        migrations.AddIndex(
+            model_name="content",
+            index=models.Index(
+                condition=models.Q(("search_vector__isnull", True)),
+                fields=["block_height"],
+                name="content_sv_pending_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0008_content_search_vector_deferred"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="coinbasescriptsig",
+            name="context_revision",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="pages.contextrevision",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="content",
+            name="context_revision",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="pages.contextrevision",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="inscription",
+            name="context_revision",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="pages.contextrevision",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="opreturn",
+            name="context_revision",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="pages.contextrevision",
+            ),
+        ),
+        migrations.CreateModel(
+            name="LegacyContext",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("content_hash", models.BinaryField()),
+            ],
+        ),
+        # Collapse revisions created at ingest which were never edited, keeping
+        # which content their ids addressed for old context urls
+        migrations.RunSQL(
+            sql="""
+            CREATE TEMPORARY TABLE empty_context_revision ON COMMIT DROP AS
+            SELECT r.id FROM pages_contextrevision r
+            WHERE r.html = ''
+                AND r.user_id IS NULL
+                AND r.prev_revision_id IS NULL
+                AND NOT EXISTS (
+                    SELECT 1 FROM pages_contextrevision n WHERE n.prev_revision_id = r.id
+                );
+            CREATE UNIQUE INDEX ON empty_context_revision (id);
+            ANALYZE empty_context_revision;
+
+            INSERT INTO pages_legacycontext (id, content_hash)
+            SELECT DISTINCT ON (c.context_revision_id) c.context_revision_id, c.hash
+            FROM pages_content c
+            JOIN empty_context_revision e ON e.id = c.context_revision_id
+            ORDER BY c.context_revision_id, c.id;
+
+            UPDATE pages_content SET context_revision_id = NULL
+            WHERE context_revision_id IN (SELECT id FROM empty_context_revision);
+            UPDATE pages_inscription SET context_revision_id = NULL
+            WHERE context_revision_id IN (SELECT id FROM empty_context_revision);
+            UPDATE pages_opreturn SET context_revision_id = NULL
+            WHERE context_revision_id IN (SELECT id FROM empty_context_revision);
+            UPDATE pages_coinbasescriptsig SET context_revision_id = NULL
+            WHERE context_revision_id IN (SELECT id FROM empty_context_revision);
+
+            DELETE FROM pages_contextrevision
+            WHERE id IN (SELECT id FROM empty_context_revision);
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0009_lazy_context_revision"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MediaFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("filename", models.CharField(unique=True)),
+                ("refcount", models.BigIntegerField(default=0)),
+            ],
+        ),
+        # Count references of files saved before the media store
+        migrations.RunSQL(
+            sql="""
+            INSERT INTO pages_mediafile (filename, refcount)
+            SELECT filename, count(*) FROM pages_inscription
+            WHERE filename IS NOT NULL
+            GROUP BY filename;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0010_mediafile"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tx",
+            name="offset",
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="tx",
+            name="size",
+            field=models.IntegerField(null=True),
+        ),
+    ]
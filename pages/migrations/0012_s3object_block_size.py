@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0011_tx_offset_size"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="S3Object",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(unique=True)),
+                ("size", models.BigIntegerField()),
+                ("etag", models.CharField()),
+                ("uploaded_at", models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name="block",
+            name="size",
+            field=models.IntegerField(null=True),
+        ),
+    ]
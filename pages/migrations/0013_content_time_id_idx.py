@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0012_s3object_block_size"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="content",
+            index=models.Index(fields=["block_time", "id"], name="content_time_id_idx"),
+        ),
+    ]
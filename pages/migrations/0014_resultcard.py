@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0013_content_time_id_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ResultCard",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("object_type", models.CharField()),
+                ("txid", models.CharField()),
+                ("filename", models.CharField(null=True)),
+                ("text", models.TextField(null=True)),
+                ("text_json", models.JSONField(null=True)),
+                (
+                    "content",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="card",
+                        to="pages.content",
+                    ),
+                ),
+            ],
+        ),
+        # Cards of content ingested before result cards
+        migrations.RunSQL(
+            sql="""
+            INSERT INTO pages_resultcard
+                (content_id, object_type, txid, filename, text, text_json)
+            SELECT
+                c.id,
+                CASE
+                    WHEN c.inscription_id IS NOT NULL THEN 'Inscription'
+                    WHEN c.op_return_id IS NOT NULL THEN 'OpReturn'
+                    ELSE 'CoinbaseScriptsig'
+                END,
+                tx.txid,
+                i.filename,
+                left(COALESCE(i.text, o.scriptpubkey_text, cs.scriptsig_text), 1024),
+                CASE WHEN i.json ->> 'p' = 'brc-20' THEN i.json END
+            FROM pages_content c
+            LEFT JOIN pages_inscription i ON i.id = c.inscription_id
+            LEFT JOIN pages_coinbasescriptsig cs ON cs.id = c.coinbase_scriptsig_id
+            LEFT JOIN pages_opreturn o ON o.id = c.op_return_id
+            LEFT JOIN pages_txin txin ON txin.id = COALESCE(i.txin_id, cs.txin_id)
+            LEFT JOIN pages_txout txout ON txout.id = o.txout_id
+            JOIN pages_tx tx ON tx.id = COALESCE(txin.tx_id, txout.tx_id);
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0014_resultcard"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="resultcard",
+            name="block_binary",
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0015_resultcard_block_binary"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ContentFacet",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("mime_type", models.CharField()),
+                ("mime_subtype", models.CharField(default="")),
+                ("object_type", models.CharField()),
+                ("is_brc20", models.BooleanField(default=False)),
+                ("count", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("mime_type", "mime_subtype", "object_type", "is_brc20"),
+                        name="contentfacet_unique",
+                    )
+                ],
+            },
+        ),
+        # Count content indexed before facets
+        migrations.RunSQL(
+            sql="""
+            INSERT INTO pages_contentfacet
+                (mime_type, mime_subtype, object_type, is_brc20, count)
+            SELECT
+                mime_type,
+                COALESCE(mime_subtype, ''),
+                CASE
+                    WHEN inscription_id IS NOT NULL THEN 'Inscription'
+                    WHEN op_return_id IS NOT NULL THEN 'OpReturn'
+                    ELSE 'CoinbaseScriptsig'
+                END,
+                COALESCE(is_brc20, false),
+                count(*)
+            FROM pages_content
+            GROUP BY 1, 2, 3, 4;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -17,10 +17,11 @@ class Block(models.Model):
 
     coinbase_tx = models.BinaryField()
     number_of_txns = models.IntegerField()
+    size = models.IntegerField(null=True)  # raw block bytes
 
-    def serialized(self) -> bytes:
+    def header(self) -> bytes:
         """
-        Return serialized block bytes, up to and including coinbase transaction
+        Return serialized 80 byte block header
         """
         return (
             self.version.to_bytes(4, "little")
@@ -28,11 +29,15 @@ class Block(models.Model):
             + bytes.fromhex(self.merkle_root)[::-1]
             + self.time.to_bytes(4, "little")
             + bytes.fromhex(self.bits)[::-1]
-            + self.nonce.to_bytes(8, "little")
-            + compact_size_uint(self.number_of_txns)
-            + self.coinbase_tx
+            + self.nonce.to_bytes(4, "little")
         )
 
+    def serialized(self) -> bytes:
+        """
+        Return serialized block bytes, up to and including coinbase transaction
+        """
+        return self.header() + compact_size_uint(self.number_of_txns) + self.coinbase_tx
+
     def __str__(self):
         return f"<Block height={self.blockheight}>"
 
@@ -47,6 +52,10 @@ class Tx(models.Model):
     version = models.IntegerField()
     locktime = models.BigIntegerField()
 
+    # location of raw tx within the block, null if indexed before recorded
+    offset = models.IntegerField(null=True)
+    size = models.IntegerField(null=True)
+
     def __str__(self):
         return f"<Tx n={self.n} block={self.block}>"
 
@@ -65,6 +74,17 @@ class ContextRevision(models.Model):
         return f"<ContextRevision id={self.id}>"
 
 
+class LegacyContext(models.Model):
+    # context revisions created at ingest and never edited were removed once
+    # revisions were created on first edit; content was addressed by their
+    # ids, which are kept here for old /context/<id> urls
+    id = models.BigIntegerField(primary_key=True)
+    content_hash = models.BinaryField()
+
+    def __str__(self):
+        return f"<LegacyContext id={self.id} content_hash={self.content_hash.hex()}>"
+
+
 class Content(models.Model):
     hash = models.BinaryField(unique=True)
     mime_type = models.CharField(db_index=True)
@@ -87,8 +107,9 @@ class Content(models.Model):
 
     is_brc20 = models.BooleanField(null=True, db_index=True)
 
+    # created on first edit
     context_revision = models.ForeignKey(
-        ContextRevision, on_delete=models.CASCADE, null=True
+        ContextRevision, on_delete=models.SET_NULL, null=True
     )
 
     class Meta:
@@ -128,14 +149,16 @@ class Content(models.Model):
                 name="content_not_brc20_idx",
                 condition=models.Q(is_brc20=False),
             ),
+            # Keyset pagination of the index, newest or oldest first
+            models.Index(fields=["block_time", "id"], name="content_time_id_idx"),
+            # Rows ingested with a deferred search vector, pending backfill
+            models.Index(
+                fields=["block_height"],
+                name="content_sv_pending_idx",
+                condition=models.Q(search_vector__isnull=True),
+            ),
         ]
 
-    def save(self, *args, **kwargs):
-        if self.context_revision_id is None:
-            self.context_revision = ContextRevision()
-            self.context_revision.save()
-        super().save(*args, **kwargs)
-
     def __str__(self):
         # pylint: disable=no-member
         if self.inscription_id is not None:
@@ -167,15 +190,9 @@ class CoinbaseScriptsig(models.Model):
     scriptsig = models.BinaryField()
     scriptsig_text = models.CharField(null=True)
 
-    context_revision = models.ForeignKey(ContextRevision, on_delete=models.CASCADE)
-
-    def save(self, *args, **kwargs):
-        if self.context_revision_id is None:
-            self.context_revision = ContextRevision()
-            self.context_revision.content_type = "CoinbaseScriptsig"
-            self.context_revision.block_time = self.txin.tx.block.time
-            self.context_revision.save()
-        super().save(*args, **kwargs)
+    context_revision = models.ForeignKey(
+        ContextRevision, on_delete=models.SET_NULL, null=True
+    )
 
 
 class TxOut(models.Model):
@@ -193,15 +210,9 @@ class OpReturn(models.Model):
     scriptpubkey = models.BinaryField()
     scriptpubkey_text = models.CharField()
 
-    context_revision = models.ForeignKey(ContextRevision, on_delete=models.CASCADE)
-
-    def save(self, *args, **kwargs):
-        if self.context_revision_id is None:
-            self.context_revision = ContextRevision()
-            self.context_revision.content_type = "OpReturn"
-            self.context_revision.block_time = self.txout.tx.block.time
-            self.context_revision.save()
-        super().save(*args, **kwargs)
+    context_revision = models.ForeignKey(
+        ContextRevision, on_delete=models.SET_NULL, null=True
+    )
 
     def __str__(self):
         return f"<OpReturn txout={self.txout}>"
@@ -236,17 +247,76 @@ class Inscription(models.Model):
 
     txin = models.ForeignKey(TxIn, on_delete=models.CASCADE)
 
-    context_revision = models.ForeignKey(ContextRevision, on_delete=models.CASCADE)
-
-    def save(self, *args, **kwargs):
-        if self.context_revision_id is None:
-            self.context_revision = ContextRevision()
-            self.context_revision.content_type = "Inscription"
-            self.context_revision.block_time = self.txin.tx.block.time
-            self.context_revision.save()
-        super().save(*args, **kwargs)
+    context_revision = models.ForeignKey(
+        ContextRevision, on_delete=models.SET_NULL, null=True
+    )
 
     def __str__(self):
         if self.number is not None:
             return f"<Inscription number={self.number} txin={self.txin}>"
         return f"<Inscription id={self.id} txin={self.txin}>"
+
+
+class MediaFile(models.Model):
+    # file in the media store, with the number of inscriptions referencing it
+    filename = models.CharField(unique=True)
+    refcount = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"<MediaFile filename={self.filename} refcount={self.refcount}>"
+
+
+class S3Object(models.Model):
+    # manifest of objects archived in the s3 bucket
+    key = models.CharField(unique=True)
+    size = models.BigIntegerField()
+    etag = models.CharField()
+    uploaded_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"<S3Object key={self.key} size={self.size}>"
+
+
+class ResultCard(models.Model):
+    # what the index grid shows of content, denormalized at ingest so a page
+    # is one query joining Content; mime type, block height and time, and the
+    # context url come from the Content row itself
+    content = models.OneToOneField(
+        Content, on_delete=models.CASCADE, related_name="card"
+    )
+    object_type = models.CharField()
+    txid = models.CharField()
+    filename = models.CharField(null=True)
+    # truncated to CARD_TEXT_LENGTH
+    text = models.TextField(null=True)
+    # brc-20 json only
+    text_json = models.JSONField(null=True)
+    # binary string of the block header and coinbase tx, shown behind
+    # CoinbaseScriptsig cards only; filled on first view for older cards
+    block_binary = models.TextField(null=True)
+
+    def __str__(self):
+        return (
+            f"<ResultCard object_type={self.object_type} content_id={self.content_id}>"
+        )
+
+
+class ContentFacet(models.Model):
+    # number of content rows of each kind, kept up to date by ingestion, for
+    # the content type filters; mime_subtype is "" for content without one
+    mime_type = models.CharField()
+    mime_subtype = models.CharField(default="")
+    object_type = models.CharField()
+    is_brc20 = models.BooleanField(default=False)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["mime_type", "mime_subtype", "object_type", "is_brc20"],
+                name="contentfacet_unique",
+            )
+        ]
+
+    def __str__(self):
+        return f"<ContentFacet {self.mime_type}/{self.mime_subtype} object_type={self.object_type} is_brc20={self.is_brc20} count={self.count}>"
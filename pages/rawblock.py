@@ -0,0 +1,195 @@
+import hashlib
+from typing import Iterator, List, Tuple
+
+
+def hash256(*chunks) -> bytes:
+    """
+    Double sha256 of the concatenation of chunks, without concatenating them
+    """
+    h = hashlib.sha256()
+    for chunk in chunks:
+        h.update(chunk)
+    return hashlib.sha256(h.digest()).digest()
+
+
+def read_compact_size(buf: memoryview, i: int) -> Tuple[int, int]:
+    """
+    Read compact size uint at cursor i
+    Returns:
+        Tuple[int, int]: value, cursor positioned after it
+    """
+    prefix = buf[i]
+    if prefix < 0xFD:
+        return prefix, i + 1
+    elif prefix == 0xFD:
+        return int.from_bytes(buf[i + 1 : i + 3], "little"), i + 3
+    elif prefix == 0xFE:
+        return int.from_bytes(buf[i + 1 : i + 5], "little"), i + 5
+    return int.from_bytes(buf[i + 1 : i + 9], "little"), i + 9
+
+
+def parse_header(raw_block: bytes | memoryview) -> dict:
+    """
+    Parse the 80 byte block header and transaction count
+    Returns:
+        dict: contains keys:
+            blockheaderhash: str
+            version: int
+            prev_blockheaderhash: str
+            merkle_root_hash: str
+            nTime: int
+            nBits: str
+            nNonce: int
+            number_of_txns: int
+    """
+    buf = memoryview(raw_block)
+    header = buf[:80]
+    number_of_txns, _ = read_compact_size(buf, 80)
+    return {
+        "blockheaderhash": hash256(header)[::-1].hex(),
+        "version": int.from_bytes(header[0:4], "little"),
+        "prev_blockheaderhash": bytes(header[4:36])[::-1].hex(),
+        "merkle_root_hash": bytes(header[36:68])[::-1].hex(),
+        "nTime": int.from_bytes(header[68:72], "little"),
+        "nBits": bytes(header[72:76])[::-1].hex(),
+        "nNonce": int.from_bytes(header[76:80], "little"),
+        "number_of_txns": number_of_txns,
+    }
+
+
+class RawTx:
+    """
+    Transaction within a raw block buffer
+
+    Only the input and output boundaries are walked on construction; scripts
+    and witness elements are exposed as memoryviews into the block buffer and
+    txid, wtxid and witnesses are computed on first access
+    """
+
+    __slots__ = (
+        "buf",
+        "n",
+        "offset",
+        "size",
+        "version",
+        "locktime",
+        "txins",
+        "txouts",
+        "_body",
+        "_witness",
+        "_txid",
+        "_wtxid",
+        "_witnesses",
+    )
+
+    def __init__(self, buf: memoryview, offset: int, n: int):
+        self.buf = buf
+        self.n = n
+        self.offset = offset
+        self.version = int.from_bytes(buf[offset : offset + 4], "little")
+        i = offset + 4
+        segwit = buf[i] == 0 and buf[i + 1] != 0
+        if segwit:
+            i += 2  # marker, flag
+        body_start = i
+
+        # txins: (prev txid, vout, scriptsig, sequence)
+        txins = []
+        number_of_txins, i = read_compact_size(buf, i)
+        for _ in range(number_of_txins):
+            outpoint = buf[i : i + 36]
+            scriptsig_len, i = read_compact_size(buf, i + 36)
+            scriptsig = buf[i : i + scriptsig_len]
+            i += scriptsig_len
+            sequence = int.from_bytes(buf[i : i + 4], "little")
+            i += 4
+            txins.append(
+                (
+                    outpoint[:32],
+                    int.from_bytes(outpoint[32:], "little"),
+                    scriptsig,
+                    sequence,
+                )
+            )
+        # txouts: (value, scriptpubkey)
+        txouts = []
+        number_of_txouts, i = read_compact_size(buf, i)
+        for _ in range(number_of_txouts):
+            value = int.from_bytes(buf[i : i + 8], "little")
+            scriptpubkey_len, i = read_compact_size(buf, i + 8)
+            txouts.append((value, buf[i : i + scriptpubkey_len]))
+            i += scriptpubkey_len
+        self._body = (body_start, i)
+
+        witness_start = i
+        if segwit:
+            for _ in range(number_of_txins):
+                number_of_elements, i = read_compact_size(buf, i)
+                for _ in range(number_of_elements):
+                    element_len, i = read_compact_size(buf, i)
+                    i += element_len
+        self._witness = (witness_start, i) if segwit else None
+
+        self.locktime = int.from_bytes(buf[i : i + 4], "little")
+        self.size = i + 4 - offset
+        self.txins = txins
+        self.txouts = txouts
+        self._txid = None
+        self._wtxid = None
+        self._witnesses = None
+
+    @property
+    def raw(self) -> memoryview:
+        return self.buf[self.offset : self.offset + self.size]
+
+    @property
+    def txid(self) -> str:
+        if self._txid is None:
+            end = self.offset + self.size
+            self._txid = hash256(
+                self.buf[self.offset : self.offset + 4],
+                self.buf[self._body[0] : self._body[1]],
+                self.buf[end - 4 : end],
+            )[::-1].hex()
+        return self._txid
+
+    @property
+    def wtxid(self) -> str:
+        if self._wtxid is None:
+            if self._witness is None:
+                self._wtxid = self.txid
+            else:
+                self._wtxid = hash256(self.raw)[::-1].hex()
+        return self._wtxid
+
+    @property
+    def witnesses(self) -> List[List[memoryview]]:
+        """
+        Witness stack of each txin, empty for non-segwit transactions
+        """
+        if self._witnesses is None:
+            self._witnesses = []
+            if self._witness is not None:
+                buf = self.buf
+                i = self._witness[0]
+                for _ in self.txins:
+                    stack = []
+                    number_of_elements, i = read_compact_size(buf, i)
+                    for _ in range(number_of_elements):
+                        element_len, i = read_compact_size(buf, i)
+                        stack.append(buf[i : i + element_len])
+                        i += element_len
+                    self._witnesses.append(stack)
+        return self._witnesses
+
+
+def iter_txs(raw_block: bytes | memoryview) -> Iterator[RawTx]:
+    """
+    Lazily iterate transactions of a raw block, without copying
+    """
+    buf = memoryview(raw_block)
+    number_of_txns, i = read_compact_size(buf, 80)
+    for n in range(number_of_txns):
+        tx = RawTx(buf, i, n)
+        i += tx.size
+        yield tx
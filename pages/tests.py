@@ -1,3 +1,1008 @@
-from django.test import TestCase
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from typing import List
+from unittest import mock
 
-# Create your tests here.
+from bits import compact_size_uint, constants
+from bits.blockchain import Block
+from bits.tx import tx_ser
+from django.contrib.postgres.search import SearchVector
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+
+from . import blockarchive, ingest, models, utils
+from .bitcoind import BlockFileIndex
+from .facets import get_facets, rebuild_facets
+from .ingest import commit_block, parse_block
+from .management.commands import index, sync
+from .mediastore import MediaStore
+from .management.commands.normalize import normalize_chunk
+from .rawblock import iter_txs, parse_header
+from .utils import parse_inscriptions
+from .views import card_block_binary
+
+
+def parse_inscriptions_reference(witness_element: bytes | str) -> List[dict]:
+    """
+    parse_inscriptions as it was before it was rewritten to walk a memoryview,
+    which the current parser must agree with
+    """
+    if type(witness_element) is str:
+        witness_element = bytes.fromhex(witness_element)
+    inscriptions = []
+    ord_envelope_begin = witness_element.find(
+        b"\x00\x63\x03ord"
+    )  # OP_FALSE OP_IF OP_PUSHBYTES3 ord
+    while ord_envelope_begin != -1:
+        inscription = {}
+
+        witness_element = witness_element[ord_envelope_begin:]
+        witness_element = witness_element[
+            6:
+        ]  # skip 'OP_FALSE OP_IF OP_PUSHBYTES3 ord' preamble
+
+        while witness_element and witness_element[0] != constants.OP_ENDIF:
+            # parse the OP_PUSH and tag
+            if witness_element[0] in range(1, 0x4C):
+                push = witness_element[0]
+                tag = witness_element[1 : 1 + push]
+                witness_element = witness_element[1 + push :]
+            elif witness_element[0] == constants.OP_PUSHDATA1:
+                push = witness_element[1]
+                tag = witness_element[2 : 2 + push]
+                witness_element = witness_element[2 + push :]
+            elif witness_element[0] == constants.OP_PUSHDATA2:
+                push = int.from_bytes(witness_element[1:3], "little")
+                tag = witness_element[3 : 3 + push]
+                witness_element = witness_element[3 + push :]
+            elif witness_element[0] == constants.OP_0:
+                tag = b"\x00"
+                witness_element = witness_element[1:]
+            elif witness_element[0] == constants.OP_1:
+                tag = b"\x01"
+                witness_element = witness_element[1:]
+            elif witness_element[0] == constants.OP_2:
+                tag = b"\x02"
+                witness_element = witness_element[1:]
+            elif witness_element[0] == constants.OP_3:
+                tag = b"\x03"
+                witness_element = witness_element[1:]
+            elif witness_element[0] == constants.OP_5:
+                tag = b"\x05"
+                witness_element = witness_element[1:]
+            else:
+                raise ValueError(
+                    f"Invalid data push while parsing tag: {witness_element[0]}"
+                )
+            if tag == b"\x01":
+                # content type
+                push = witness_element[0]
+                content_type = witness_element[1 : 1 + push].decode("utf8")
+                witness_element = witness_element[1 + push :]
+                inscription["content_type"] = content_type
+            elif tag == b"\x00":
+                # data
+                data = b""
+                while witness_element and witness_element[0] != 104:
+                    if witness_element[0] in range(1, 0x4C):
+                        push = witness_element[0]
+                        data += witness_element[1 : 1 + push]
+                        witness_element = witness_element[1 + push :]
+                    elif witness_element[0] == 0x4C:  # OP_PUSHDATA1
+                        push = witness_element[1]
+                        data += witness_element[2 : 2 + push]
+                        witness_element = witness_element[2 + push :]
+                    elif witness_element[0] == 0x4D:  # OP_PUSHDATA2
+                        push = int.from_bytes(witness_element[1:3], "little")
+                        data += witness_element[3 : 3 + push]
+                        witness_element = witness_element[3 + push :]
+                    else:
+                        raise ValueError(f"Invalid data push: {witness_element[0]}")
+                inscription["data"] = data
+            elif tag == b"\x0b":
+                # delegate
+                # parse txid and index
+                push = witness_element[0]
+                delegate = witness_element[1 : 1 + push]
+                witness_element = witness_element[1 + push :]
+                txid = delegate[:32][::-1].hex()
+                index = int.from_bytes(delegate[32:], "little")
+                inscription["delegate"] = f"{txid}i{index}"
+            elif tag == b"\x05":
+                # metadata
+                metadata = b""
+                if witness_element[0] in range(1, 0x4C):
+                    push = witness_element[0]
+                    metadata += witness_element[1 : 1 + push]
+                    witness_element = witness_element[1 + push :]
+                elif witness_element[0] == 0x4C:  # OP_PUSHDATA1
+                    push = witness_element[1]
+                    metadata += witness_element[2 : 2 + push]
+                    witness_element = witness_element[2 + push :]
+                elif witness_element[0] == 0x4D:  # OP_PUSHDATA2
+                    push = int.from_bytes(witness_element[1:3], "little")
+                    metadata += witness_element[3 : 3 + push]
+                    witness_element = witness_element[3 + push :]
+                else:
+                    raise ValueError(f"Invalid data push: {witness_element[0]}")
+                if inscription.get("metadata", None) is None:
+                    inscription["metadata"] = metadata
+                else:
+                    inscription["metadata"] += metadata
+            elif tag == b"\x02":
+                # pointer
+                push = witness_element[0]
+                pointer = witness_element[1 : 1 + push]
+                witness_element = witness_element[1 + push :]
+                inscription["pointer"] = int.from_bytes(pointer, "little")
+            elif tag == b"\x11":
+                # properties
+                properties = b""
+                if witness_element[0] in range(1, 0x4C):
+                    push = witness_element[0]
+                    properties += witness_element[1 : 1 + push]
+                    witness_element = witness_element[1 + push :]
+                elif witness_element[0] == 0x4C:  # OP_PUSHDATA1
+                    push = witness_element[1]
+                    properties += witness_element[2 : 2 + push]
+                    witness_element = witness_element[2 + push :]
+                elif witness_element[0] == 0x4D:  # OP_PUSHDATA2
+                    push = int.from_bytes(witness_element[1:3], "little")
+                    properties += witness_element[3 : 3 + push]
+                    witness_element = witness_element[3 + push :]
+                else:
+                    raise ValueError(f"Invalid data push: {witness_element[0]}")
+                if inscription.get("properties", None) is None:
+                    inscription["properties"] = properties
+                else:
+                    inscription["properties"] += properties
+            elif tag == b"\x03":
+                # provenance
+                # parse txid
+                push = witness_element[0]
+                provenance = witness_element[1 : 1 + push]
+                witness_element = witness_element[1 + push :]
+                txid = provenance[:32][::-1].hex()
+                index = int.from_bytes(provenance[32:], "little")
+                inscription["provenance"] = f"{txid}i{index}"
+            else:
+                raise ValueError(f"Unexpected tag: {tag}")
+        inscriptions.append(inscription)
+
+        ord_envelope_begin = witness_element.find(b"\x00\x63\x03ord")
+
+    return inscriptions
+
+
+def push(data: bytes, opcode: int = None) -> bytes:
+    """
+    Script push of data, with the smallest push opcode unless given
+    """
+    if opcode is None:
+        if len(data) < constants.OP_PUSHDATA1:
+            opcode = len(data)
+        elif len(data) < 0x100:
+            opcode = constants.OP_PUSHDATA1
+        else:
+            opcode = constants.OP_PUSHDATA2
+    if opcode == constants.OP_PUSHDATA1:
+        return bytes([opcode, len(data)]) + data
+    elif opcode == constants.OP_PUSHDATA2:
+        return bytes([opcode]) + len(data).to_bytes(2, "little") + data
+    elif opcode == 0x4E:  # OP_PUSHDATA4
+        return bytes([opcode]) + len(data).to_bytes(4, "little") + data
+    return bytes([opcode]) + data
+
+
+def envelope(
+    content_type: bytes, body: bytes, chunk_size: int = 520, tags: bytes = b""
+) -> bytes:
+    """
+    Inscription envelope the way ord builds it, with the body split into
+    chunk_size pushes
+    """
+    return (
+        b"\x00\x63"  # OP_FALSE OP_IF
+        + push(b"ord")
+        + push(b"\x01")
+        + push(content_type)
+        + tags
+        + b"\x00"  # body tag
+        + b"".join(
+            push(body[i : i + chunk_size]) for i in range(0, len(body), chunk_size)
+        )
+        + b"\x68"  # OP_ENDIF
+    )
+
+
+# taproot script path: <pubkey> OP_CHECKSIG <envelope>
+SCRIPT_PREFIX = push(bytes(range(32))) + b"\xac"
+
+
+class ParseInscriptionsTestCase(SimpleTestCase):
+    def assert_parsers_agree(self, witness_element: bytes) -> List[dict]:
+        inscriptions = parse_inscriptions(witness_element)
+        self.assertEqual(inscriptions, parse_inscriptions_reference(witness_element))
+        self.assertEqual(parse_inscriptions(memoryview(witness_element)), inscriptions)
+        self.assertEqual(parse_inscriptions(witness_element.hex()), inscriptions)
+        return inscriptions
+
+    def test_text(self):
+        element = SCRIPT_PREFIX + envelope(
+            b"text/plain;charset=utf-8", b"Hello, world!"
+        )
+        inscriptions = self.assert_parsers_agree(element)
+        self.assertEqual(
+            inscriptions,
+            [{"content_type": "text/plain;charset=utf-8", "data": b"Hello, world!"}],
+        )
+
+    def test_multi_chunk_body(self):
+        body = bytes(i % 251 for i in range(100_000))
+        # 520 byte chunks are OP_PUSHDATA2, 200 byte chunks OP_PUSHDATA1, 75
+        # byte chunks direct pushes
+        for chunk_size in (520, 200, 75):
+            with self.subTest(chunk_size=chunk_size):
+                element = SCRIPT_PREFIX + envelope(b"image/png", body, chunk_size)
+                inscriptions = self.assert_parsers_agree(element)
+                self.assertEqual(inscriptions[0]["data"], body)
+
+    def test_explicit_push_opcodes(self):
+        # body chunks pushed with opcodes larger than needed
+        for opcode in (constants.OP_PUSHDATA1, constants.OP_PUSHDATA2):
+            with self.subTest(opcode=opcode):
+                element = (
+                    SCRIPT_PREFIX
+                    + envelope(b"text/plain", b"")[:-1]
+                    + push(b"abc", opcode)
+                    + push(b"def", opcode)
+                    + b"\x68"
+                )
+                inscriptions = self.assert_parsers_agree(element)
+                self.assertEqual(inscriptions[0]["data"], b"abcdef")
+
+    def test_content_type_pushdata(self):
+        # the reference parser read every tag value as a direct push; values
+        # pushed with OP_PUSHDATA1/2 are now read as the pushes they are
+        for opcode in (constants.OP_PUSHDATA1, constants.OP_PUSHDATA2):
+            with self.subTest(opcode=opcode):
+                element = (
+                    SCRIPT_PREFIX
+                    + b"\x00\x63"
+                    + push(b"ord")
+                    + push(b"\x01")
+                    + push(b"text/plain", opcode)
+                    + b"\x00"
+                    + push(b"abc")
+                    + b"\x68"
+                )
+                self.assertEqual(
+                    parse_inscriptions(element),
+                    [{"content_type": "text/plain", "data": b"abc"}],
+                )
+
+    def test_pushdata4_rejected(self):
+        # OP_PUSHDATA4 can't be used in an envelope, it's over the 520 byte
+        # push limit; both parsers reject it
+        element = SCRIPT_PREFIX + envelope(b"text/plain", b"")[:-1]
+        element += push(b"abc", 0x4E) + b"\x68"
+        with self.assertRaises(ValueError):
+            parse_inscriptions_reference(element)
+        with self.assertRaises(ValueError):
+            parse_inscriptions(element)
+
+    def test_tags(self):
+        txid = bytes(range(32))
+        tags = (
+            push(b"\x02")
+            + push((1234).to_bytes(2, "little"))  # pointer
+            + push(b"\x05")
+            + push(b"\xa1" * 300)  # metadata, in two chunks
+            + push(b"\x05")
+            + push(b"\xa2" * 10)
+            + push(b"\x0b")
+            + push(txid + b"\x01")  # delegate
+            + push(b"\x03")
+            + push(txid)  # provenance
+            + push(b"\x11")
+            + push(b"\xb0" * 5)  # properties
+        )
+        element = SCRIPT_PREFIX + envelope(b"text/html", b"<p>hi</p>", tags=tags)
+        (inscription,) = self.assert_parsers_agree(element)
+        self.assertEqual(inscription["pointer"], 1234)
+        self.assertEqual(inscription["metadata"], b"\xa1" * 300 + b"\xa2" * 10)
+        self.assertEqual(inscription["delegate"], f"{txid[::-1].hex()}i1")
+        self.assertEqual(inscription["provenance"], f"{txid[::-1].hex()}i0")
+        self.assertEqual(inscription["properties"], b"\xb0" * 5)
+
+    def test_multiple_envelopes(self):
+        element = (
+            SCRIPT_PREFIX
+            + envelope(b"text/plain", b"first")
+            + envelope(b"application/json", b'{"p":"brc-20"}')
+            + envelope(b"image/webp", bytes(1000))
+        )
+        inscriptions = self.assert_parsers_agree(element)
+        self.assertEqual(
+            [inscription["content_type"] for inscription in inscriptions],
+            ["text/plain", "application/json", "image/webp"],
+        )
+
+    def test_no_envelope(self):
+        self.assertEqual(self.assert_parsers_agree(SCRIPT_PREFIX + bytes(64)), [])
+
+    def test_truncated_push(self):
+        # a push running past the end of the element: the reference parser
+        # returned the body truncated to the bytes present, the current parser
+        # raises ValueError, which the indexer logs and skips
+        element = SCRIPT_PREFIX + envelope(b"image/png", bytes(range(256)) * 8)
+        for end in (len(element) - 100, len(element) - 2):
+            with self.subTest(end=end):
+                truncated = element[:end]
+                (inscription,) = parse_inscriptions_reference(truncated)
+                self.assertLess(len(inscription["data"]), 2048)
+                with self.assertRaises(ValueError):
+                    parse_inscriptions(truncated)
+
+    def test_truncated_push_header(self):
+        # element ending within an OP_PUSHDATA2 length
+        element = SCRIPT_PREFIX + envelope(b"image/png", bytes(600))
+        truncated = element[: element.index(b"\x4d\x08\x02") + 2]
+        with self.assertRaises(ValueError):
+            parse_inscriptions(truncated)
+
+
+def serialize_tx(
+    txins: List[tuple],
+    txouts: List[tuple],
+    witnesses: List[List[bytes]] = None,
+    version: int = 2,
+    locktime: int = 0,
+) -> bytes:
+    """
+    Serialize a transaction, with segwit marker and flag if witnesses given
+    Args:
+        txins: List[tuple], (prev txid, vout, scriptsig, sequence)
+        txouts: List[tuple], (value, scriptpubkey)
+        witnesses: List[List[bytes]], witness stack of each txin
+    """
+    return (
+        version.to_bytes(4, "little")
+        + (b"\x00\x01" if witnesses else b"")
+        + compact_size_uint(len(txins))
+        + b"".join(
+            prev_txid
+            + vout.to_bytes(4, "little")
+            + compact_size_uint(len(scriptsig))
+            + scriptsig
+            + sequence.to_bytes(4, "little")
+            for prev_txid, vout, scriptsig, sequence in txins
+        )
+        + compact_size_uint(len(txouts))
+        + b"".join(
+            value.to_bytes(8, "little") + compact_size_uint(len(script)) + script
+            for value, script in txouts
+        )
+        + b"".join(
+            compact_size_uint(len(stack))
+            + b"".join(compact_size_uint(len(element)) + element for element in stack)
+            for stack in witnesses or []
+        )
+        + locktime.to_bytes(4, "little")
+    )
+
+
+def segwit_block() -> bytes:
+    """
+    Raw block with a segwit coinbase, a legacy transaction and a segwit
+    transaction with an inscription, with compact sizes wider than a byte
+    """
+    coinbase_tx = serialize_tx(
+        [(b"\x00" * 32, 0xFFFFFFFF, b"\x03\x40\x0d\x03/miner/", 0xFFFFFFFF)],
+        [
+            (625000000, b"\x00\x14" + bytes(range(20))),
+            (0, b"\x6a\x24\xaa\x21\xa9\xed" + bytes(range(32))),
+        ],
+        witnesses=[[b"\x00" * 32]],
+    )
+    legacy_tx = serialize_tx(
+        [
+            (hashlib.sha256(b"a").digest(), 3, push(bytes(range(71))), 0xFFFFFFFE),
+            (hashlib.sha256(b"b").digest(), 0, b"", 0),
+        ],
+        [
+            (1, b"\x76\xa9\x14" + bytes(20) + b"\x88\xac"),
+            (0, b"\x6a" + push(b"x" * 300)),
+            (2100000000000000, b"\x51"),
+        ],
+        version=1,
+        locktime=840000,
+    )
+    segwit_tx = serialize_tx(
+        [
+            (hashlib.sha256(b"c").digest(), 1, b"", 0xFFFFFFFD),
+            (hashlib.sha256(b"d").digest(), 2, b"\x16\x00\x14" + bytes(20), 1),
+            (hashlib.sha256(b"e").digest(), 0, b"", 0xFFFFFFFF),
+        ],
+        [(546, b"\x51\x20" + bytes(range(32)))],
+        witnesses=[
+            [bytes(range(64))],
+            [],
+            [
+                bytes(64),
+                SCRIPT_PREFIX + envelope(b"image/png", bytes(range(256)) * 4),
+                b"\xc0" + bytes(range(32)),
+            ],
+        ],
+    )
+    txs = [coinbase_tx, legacy_tx, segwit_tx]
+    header = (
+        (0x20000000).to_bytes(4, "little")
+        + hashlib.sha256(b"prev").digest()
+        + hashlib.sha256(b"".join(txs)).digest()
+        + (1713571767).to_bytes(4, "little")
+        + bytes.fromhex("17034219")[::-1]
+        + (3932395645).to_bytes(4, "little")
+    )
+    return header + compact_size_uint(len(txs)) + b"".join(txs)
+
+
+def hex_element(element) -> str:
+    return element if isinstance(element, str) else bytes(element).hex()
+
+
+class RawBlockTestCase(SimpleTestCase):
+    def test_parsers_agree(self):
+        raw_block = segwit_block()
+        block = Block(raw_block)
+
+        header = parse_header(raw_block)
+        for key in [
+            "blockheaderhash",
+            "version",
+            "prev_blockheaderhash",
+            "merkle_root_hash",
+            "nTime",
+            "nBits",
+            "nNonce",
+        ]:
+            self.assertEqual(header[key], block[key], key)
+        self.assertEqual(header["number_of_txns"], len(block["txns"]))
+
+        txs = list(iter_txs(raw_block))
+        self.assertEqual(len(txs), len(block["txns"]))
+        offset = 80 + len(compact_size_uint(len(txs)))
+        for tx, reference in zip(txs, block["txns"]):
+            serialized = tx_ser(reference)
+            self.assertEqual(tx.offset, offset)
+            self.assertEqual(tx.size, len(serialized))
+            self.assertEqual(bytes(tx.raw), serialized)
+            offset += tx.size
+
+            self.assertEqual(tx.txid, reference["txid"])
+            self.assertEqual(tx.wtxid, reference["wtxid"])
+            self.assertEqual(tx.version, reference["version"])
+            self.assertEqual(tx.locktime, reference["locktime"])
+            self.assertEqual(
+                [
+                    (bytes(prev_txid)[::-1].hex(), vout, bytes(scriptsig).hex(), seq)
+                    for prev_txid, vout, scriptsig, seq in tx.txins
+                ],
+                [
+                    (txin["txid"], txin["vout"], txin["scriptsig"], txin["sequence"])
+                    for txin in reference["txins"]
+                ],
+            )
+            self.assertEqual(
+                [(value, bytes(script).hex()) for value, script in tx.txouts],
+                [
+                    (txout["value"], txout["scriptpubkey"])
+                    for txout in reference["txouts"]
+                ],
+            )
+            self.assertEqual(
+                [[hex_element(element) for element in stack] for stack in tx.witnesses],
+                [
+                    [hex_element(element) for element in stack]
+                    for stack in reference.get("witnesses", [])
+                ],
+            )
+        self.assertEqual(offset, len(raw_block))
+        self.assertNotEqual(txs[2].txid, txs[2].wtxid)
+        self.assertEqual(txs[1].txid, txs[1].wtxid)
+
+        # the coinbase tx stored with the block
+        block_row = parse_block(1, raw_block)["blocks"][0]
+        self.assertEqual(block_row.coinbase_tx, tx_ser(block["txns"][0]))
+        self.assertEqual(
+            block_row.serialized(), raw_block[: txs[0].offset + txs[0].size]
+        )
+
+
+class SearchPagingTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        block = models.Block.objects.create(
+            blockheight=1,
+            blockheaderhash="00" * 32,
+            version=1,
+            prev_blockheaderhash="00" * 32,
+            merkle_root="00" * 32,
+            time=1231469665,
+            bits="1d00ffff",
+            nonce=0,
+            coinbase_tx=b"",
+            number_of_txns=1,
+        )
+        # 3 distinct ranks, each shared by many rows of the same block time
+        for i in range(40):
+            text = "ordinals " * (1 + i % 3) + "archive"
+            content = models.Content.objects.create(
+                hash=hashlib.sha256(text.encode("utf8") + bytes([i])).digest(),
+                mime_type="text",
+                mime_subtype="plain",
+                size=len(text),
+                params={},
+                text=text,
+                block=block,
+                block_time=block.time,
+                block_height=block.blockheight,
+            )
+            models.ResultCard.objects.create(
+                content=content, object_type="OpReturn", txid="00" * 32, text=text
+            )
+        models.Content.objects.update(
+            search_vector=SearchVector("text", config="english")
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, query: str) -> List[str]:
+        """
+        Follow next page urls through all results of query
+        Returns:
+            List[str]: context urls of results in order
+        """
+        urls = []
+        next_page_url = f"/?q={query}"
+        while next_page_url:
+            response = self.client.get(next_page_url, HTTP_HX_REQUEST="true")
+            self.assertEqual(response.status_code, 200)
+            page = response.context["results"]
+            self.assertTrue(page)
+            urls += [result["url"] for result in page]
+            next_page_url = response.context["next_page_url"]
+            self.assertLessEqual(len(urls), 40)
+        return urls
+
+    def expected(self) -> List[str]:
+        return [
+            f"/context/{content.hash.hex()}"
+            for content in models.Content.objects.order_by("-text", "-id")
+        ]
+
+    @override_settings(SEARCH_CACHE_MAX_RESULTS=0)
+    def test_tied_ranks(self):
+        self.assertEqual(self.search("ordinals"), self.expected())
+
+    def test_cached(self):
+        self.assertEqual(self.search("ordinals"), self.expected())
+
+    @override_settings(SEARCH_CACHE_MAX_RESULTS=17)
+    def test_past_cached_results(self):
+        self.assertEqual(self.search("ordinals"), self.expected())
+
+
+def coinbase_only_block(scriptsig: bytes) -> bytes:
+    """
+    Raw block with a single, legacy serialized, coinbase transaction
+    """
+    coinbase_tx = (
+        (1).to_bytes(4, "little")
+        + b"\x01"  # txins
+        + b"\x00" * 32
+        + b"\xff" * 4
+        + bytes([len(scriptsig)])
+        + scriptsig
+        + b"\xff" * 4
+        + b"\x01"  # txouts
+        + (50 * 10**8).to_bytes(8, "little")
+        + b"\x01\x51"  # OP_1
+        + b"\x00" * 4  # locktime
+    )
+    header = (
+        (1).to_bytes(4, "little")
+        + b"\x00" * 32
+        + hashlib.sha256(coinbase_tx).digest()
+        + (1231469665).to_bytes(4, "little")
+        + bytes.fromhex("1d00ffff")[::-1]
+        + (2573394689).to_bytes(4, "little")
+    )
+    return header + b"\x01" + coinbase_tx
+
+
+class BlockBinaryTestCase(TestCase):
+    def test_precomputed(self):
+        commit_block(parse_block(1, coinbase_only_block(b"\x04ordinals archive")))
+        content = models.Content.objects.select_related("block", "card").get(
+            coinbase_scriptsig__isnull=False
+        )
+        # what the index computed for every render before it was precomputed
+        expected = Block(content.block.serialized()).bin()
+        self.assertEqual(content.card.block_binary, expected)
+
+        models.ResultCard.objects.update(block_binary=None)
+        content.card.refresh_from_db()
+        self.assertEqual(card_block_binary(content), expected)
+        self.assertEqual(
+            models.ResultCard.objects.get(pk=content.card.pk).block_binary, expected
+        )
+
+
+class NormalizeFacetsTestCase(TransactionTestCase):
+    def test_normalize(self):
+        block = models.Block.objects.create(
+            blockheight=1,
+            blockheaderhash="00" * 32,
+            version=1,
+            prev_blockheaderhash="00" * 32,
+            merkle_root="00" * 32,
+            time=1231469665,
+            bits="1d00ffff",
+            nonce=0,
+            coinbase_tx=b"",
+            number_of_txns=1,
+        )
+        # content indexed before mime types were split into type and subtype
+        for i, mime_type in enumerate(["image/png", "image/png", "text", "image"]):
+            models.Content.objects.create(
+                hash=bytes([i]) * 32,
+                mime_type=mime_type,
+                mime_subtype="png" if mime_type == "image" else None,
+                size=0,
+                params={},
+                block=block,
+                block_time=0,
+            )
+        rebuild_facets()
+        cache.clear()
+
+        ids = models.Content.objects.values_list("id", flat=True)
+        normalize_chunk(min(ids), max(ids) + 1)
+        normalized = get_facets()
+        self.assertEqual(
+            [(f["mime_type"], f["mime_subtype"], f["count"]) for f in normalized],
+            [("image", "png", 3), ("text", "", 1)],
+        )
+        rebuild_facets()
+        self.assertEqual(normalized, get_facets())
+
+
+class StopSync(Exception):
+    pass
+
+
+class SyncTestCase(TestCase):
+    def test_invalid_arguments(self):
+        for option in ["prefetch", "queue_depth", "retry_every"]:
+            with self.assertRaises(CommandError):
+                call_command("sync", **{option: 0})
+
+    def fetch_block(self, blockheight: int, backend: str = None) -> bytes:
+        if blockheight == 5:
+            raise RuntimeError("backend unavailable")
+        return coinbase_only_block(b"\x04height %d" % blockheight)
+
+    @mock.patch.object(ingest, "archive_block")
+    def test_stops_at_failed_block(self, archive_block):
+        commit_block(ingest.parse_block(1, self.fetch_block(1)))
+        uploader = mock.Mock(retry_spooled=mock.Mock(return_value=0))
+        with (
+            mock.patch.object(ingest, "fetch_block", self.fetch_block),
+            mock.patch.object(sync, "get_tip_height", return_value=10),
+            mock.patch.object(sync.time, "sleep", side_effect=StopSync),
+        ):
+            with self.assertRaises(StopSync):
+                sync.Command().sync(
+                    "mempool.space",
+                    prefetch=2,
+                    queue_depth=2,
+                    interval=60,
+                    retry_every=3,
+                    uploader=uploader,
+                )
+        # heights past the failed block are left for the next poll
+        self.assertEqual(
+            list(
+                models.Block.objects.order_by("blockheight").values_list(
+                    "blockheight", flat=True
+                )
+            ),
+            [1, 2, 3, 4],
+        )
+
+
+class ContextLegacyTestCase(TestCase):
+    def test_redirects(self):
+        block = models.Block.objects.create(
+            blockheight=1,
+            blockheaderhash="00" * 32,
+            version=1,
+            prev_blockheaderhash="00" * 32,
+            merkle_root="00" * 32,
+            time=1231469665,
+            bits="1d00ffff",
+            nonce=0,
+            coinbase_tx=b"",
+            number_of_txns=1,
+        )
+        edited, unedited = (
+            models.Content.objects.create(
+                hash=bytes([i]) * 32,
+                mime_type="text",
+                size=0,
+                params={},
+                block=block,
+                block_time=0,
+            )
+            for i in range(2)
+        )
+        edited.context_revision = models.ContextRevision.objects.create(html="<p>")
+        edited.save()
+        models.LegacyContext.objects.create(id=1000, content_hash=unedited.hash)
+
+        for context_id, content in [
+            (edited.context_revision_id, edited),
+            (1000, unedited),
+        ]:
+            response = self.client.get(f"/context/{context_id}")
+            self.assertEqual(response.status_code, 301)
+            self.assertEqual(response["Location"], f"/context/{content.hash.hex()}")
+        self.assertEqual(self.client.get("/context/1001").status_code, 404)
+
+
+MAINNET_MAGIC = bytes.fromhex("f9beb4d9")
+
+
+def chain_block(prev_block: bytes | None, nonce: int = 0) -> bytes:
+    """
+    Block whose header commits to prev_block, with a nonce to tell forks apart
+    """
+    prev_hash = (
+        hashlib.sha256(hashlib.sha256(prev_block[:80]).digest()).digest()
+        if prev_block
+        else b"\x00" * 32
+    )
+    header = (
+        (1).to_bytes(4, "little")
+        + prev_hash
+        + hashlib.sha256(prev_hash).digest()
+        + (1231469665).to_bytes(4, "little")
+        + bytes.fromhex("1d00ffff")[::-1]
+        + nonce.to_bytes(4, "little")
+    )
+    return header + b"\x01" + bytes([nonce % 256]) * (100 + nonce)
+
+
+class BlockFileIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.blocks_dir = Path(tmp_dir.name) / "blocks"
+        self.blocks_dir.mkdir()
+        self.index_path = Path(tmp_dir.name) / "blockfileindex.bin"
+        self.xor_key = b""
+        self.files = {}
+
+        # main chain of 6 blocks, and a stale block competing with block 2
+        self.blocks = [chain_block(None)]
+        for height in range(1, 6):
+            self.blocks.append(chain_block(self.blocks[-1], nonce=height))
+        self.stale = chain_block(self.blocks[1], nonce=1000)
+
+    def write(self, file_no: int, blocks: List[bytes]):
+        """
+        Append block records to blk{file_no}.dat, followed by zeros like the
+        preallocated tail of a file being written, obfuscated with xor_key
+        """
+        records = self.files.get(file_no, b"") + b"".join(
+            MAINNET_MAGIC + len(block).to_bytes(4, "little") + block for block in blocks
+        )
+        self.files[file_no] = records
+        path = self.blocks_dir / f"blk{file_no:05d}.dat"
+        path.write_bytes(self.xor(records + b"\x00" * 64))
+
+    def xor(self, data: bytes) -> bytes:
+        if not self.xor_key:
+            return data
+        key = self.xor_key * (len(data) // len(self.xor_key) + 1)
+        return bytes(b ^ k for b, k in zip(data, key))
+
+    def assert_chain(self, index: BlockFileIndex, blocks: List[bytes]):
+        self.assertEqual(index.height, len(blocks) - 1)
+        for height, block in enumerate(blocks):
+            self.assertEqual(index.read_block(height), block)
+
+    def test_out_of_order(self):
+        blocks = self.blocks[:4]
+        self.write(0, [blocks[0], blocks[2]])
+        self.write(1, [blocks[3], blocks[1]])
+        index = BlockFileIndex(self.blocks_dir, self.index_path)
+        index.build()
+        self.assert_chain(index, blocks)
+        with self.assertRaises(ValueError):
+            index.read_block(4)
+
+    def test_fork(self):
+        self.write(0, [self.blocks[0], self.blocks[1], self.stale])
+        index = BlockFileIndex(self.blocks_dir, self.index_path)
+        index.build()
+        self.assert_chain(index, [self.blocks[0], self.blocks[1], self.stale])
+
+        # the competing branch overtakes the indexed tip
+        self.write(0, self.blocks[2:4])
+        index.update()
+        self.assert_chain(index, self.blocks[:4])
+
+    def test_xor(self):
+        self.xor_key = bytes.fromhex("a1b2c3d4e5f60718")
+        (self.blocks_dir / "xor.dat").write_bytes(self.xor_key)
+        self.write(0, self.blocks[:3])
+        self.write(1, self.blocks[3:])
+        index = BlockFileIndex(self.blocks_dir, self.index_path)
+        index.build()
+        self.assert_chain(index, self.blocks)
+
+    def test_update(self):
+        self.write(0, self.blocks[:3])
+        index = BlockFileIndex(self.blocks_dir, self.index_path)
+        index.build()
+        self.assert_chain(index, self.blocks[:3])
+
+        self.write(0, self.blocks[3:4])
+        self.write(1, self.blocks[4:])
+        # read past the tip extends the index
+        self.assertEqual(index.read_block(5), self.blocks[5])
+        self.assert_chain(index, self.blocks)
+        # and the extended index is saved
+        self.assert_chain(BlockFileIndex(self.blocks_dir, self.index_path), self.blocks)
+
+    def test_concurrent_update(self):
+        self.write(0, self.blocks[:2])
+        index = BlockFileIndex(self.blocks_dir, self.index_path)
+        index.build()
+        self.write(0, self.blocks[2:])
+
+        results = {}
+        errors = []
+
+        def read(height: int):
+            try:
+                results[height] = index.read_block(height)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                errors.append(err)
+
+        threads = [
+            threading.Thread(target=read, args=(height,))
+            for height in list(range(2, 6)) * 4
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, {h: self.blocks[h] for h in range(2, 6)})
+        self.assert_chain(BlockFileIndex(self.blocks_dir, self.index_path), self.blocks)
+
+
+class MediaRollbackTestCase(TransactionTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.media_store = MediaStore(tmp_dir.name)
+        patcher = mock.patch.object(
+            ingest, "get_media_store", return_value=self.media_store
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rolled_back(self):
+        raw_block = segwit_block()
+        rows = parse_block(1, raw_block)
+        (filename,) = rows["media"]
+        # a block with the same hash is already indexed, so the commit fails
+        models.Block.objects.create(
+            blockheight=0,
+            blockheaderhash=parse_header(raw_block)["blockheaderhash"],
+            version=1,
+            prev_blockheaderhash="00" * 32,
+            merkle_root="00" * 32,
+            time=0,
+            bits="1d00ffff",
+            nonce=0,
+            coinbase_tx=b"",
+            number_of_txns=1,
+        )
+        with self.assertRaises(IntegrityError):
+            commit_block(rows)
+        self.assertFalse(self.media_store.exists(filename))
+        self.assertFalse(models.MediaFile.objects.exists())
+
+    def test_referenced(self):
+        raw_block = segwit_block()
+        commit_block(parse_block(1, raw_block))
+        rows = parse_block(1, raw_block)
+        (filename,) = rows["media"]
+        self.media_store.delete(filename)
+        # saved again for the failing commit, but referenced by the first
+        with self.assertRaises(IntegrityError):
+            commit_block(rows)
+        self.assertTrue(self.media_store.exists(filename))
+        self.assertEqual(models.MediaFile.objects.get(filename=filename).refcount, 1)
+
+
+def index_block_or_fail(blockheight: int, **kwargs) -> dict:
+    if blockheight % 3 == 0:
+        raise RuntimeError("backend unavailable")
+    return {"blockheight": blockheight, "rows": 1}
+
+
+def init_no_uploader():
+    pass
+
+
+class IndexRangeTestCase(SimpleTestCase):
+    @mock.patch.object(index, "init_worker", init_no_uploader)
+    @mock.patch.object(index, "index_block_in_worker", index_block_or_fail)
+    def test_failed_blocks(self):
+        with self.assertRaisesMessage(CommandError, "[3, 6, 9]"):
+            index.Command().index_range(list(range(1, 11)), "bitcoind", workers=2)
+
+
+class S3RangeCacheTestCase(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        settings_override = override_settings(
+            S3_CACHE_DIR=Path(tmp_dir.name),
+            S3_CACHE_MAX_SIZE=1024**2,
+            S3_CACHE_CHUNK_SIZE=16,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(utils, "_s3_range_cache", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.objects = {}
+        patcher = mock.patch.object(
+            utils, "get_object_range_from_s3", self.get_object_range
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_object_range(self, key: str, start: int, end: int) -> bytes:
+        return self.objects[key][start : end + 1]
+
+    def upload(self, key: str, content: bytes, etag: str):
+        self.objects[key] = content
+        blockarchive.record_object(key, len(content), etag)
+
+    def test_reuploaded(self):
+        self.upload("block1.bin", b"stale block " * 4, '"1"')
+        self.assertEqual(blockarchive.read_block(1), b"stale block " * 4)
+        # e.g. re-uploaded after a reorg
+        self.upload("block1.bin", b"fresh block " * 4, '"2"')
+        self.assertEqual(blockarchive.read_block(1), b"fresh block " * 4)
+        self.assertEqual(
+            b"".join(blockarchive.iter_block(1, 6, 20)), (b"fresh block " * 4)[6:26]
+        )
@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django import db
+from django.conf import settings
+
+from .blockarchive import record_object
+from .utils import upload_to_s3
+
+log = logging.getLogger(__name__)
+
+
+class Uploader:
+    """
+    Upload objects to s3 in the background, off the ingest path
+
+    Submitted objects are written to a spool directory, then uploaded by a
+    pool of threads and recorded in the s3 manifest. At most max_pending
+    objects are waiting or uploading at once; submit blocks while the queue
+    is full. An object stays in the spool until its upload succeeds, so
+    uploads which failed, or were still queued when the process exited, are
+    retried by retry_spooled. Objects still queued are skipped, so long
+    running commands may retry the spool periodically.
+    """
+
+    def __init__(
+        self,
+        spool_dir: Path | str = None,
+        workers: int = None,
+        max_pending: int = None,
+    ):
+        self.spool_dir = Path(spool_dir or settings.S3_UPLOAD_SPOOL_DIR)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or settings.S3_UPLOAD_WORKERS,
+            thread_name_prefix="upload",
+        )
+        self._pending = threading.BoundedSemaphore(
+            max_pending or settings.S3_UPLOAD_QUEUE_SIZE
+        )
+        self._lock = threading.Lock()
+        self._queued = set()
+        self.failed = 0
+
+    def submit(self, key: str, content: bytes):
+        """
+        Spool content and queue its upload to key
+        """
+        path = self.spool_dir / key
+        tmp_path = path.with_name(f".{key}.{os.getpid()}.{threading.get_ident()}")
+        tmp_path.write_bytes(content)
+        tmp_path.replace(path)
+        self._queue(key, content, path)
+
+    def _queue(self, key: str, content: bytes, path: Path):
+        self._pending.acquire()
+        with self._lock:
+            self._queued.add(key)
+        self._executor.submit(self._upload, key, content, path)
+
+    def _upload(self, key: str, content: bytes, path: Path):
+        try:
+            resp = upload_to_s3(key, content)
+            record_object(key, len(content), resp["ETag"])
+            path.unlink(missing_ok=True)
+            log.info(f"{key} uploaded to s3.")
+        except Exception as err:
+            with self._lock:
+                self.failed += 1
+            log.error(f"Failed to upload {key} to s3, left in {self.spool_dir}: {err}")
+        finally:
+            with self._lock:
+                self._queued.discard(key)
+            db.connection.close()
+            self._pending.release()
+
+    def retry_spooled(self) -> int:
+        """
+        Queue uploads of objects left in the spool which are not already
+        queued
+        Returns:
+            int: number of uploads queued
+        """
+        with self._lock:
+            queued = set(self._queued)
+        paths = [
+            path
+            for path in self.spool_dir.iterdir()
+            if path.is_file()
+            and not path.name.startswith(".")
+            and path.name not in queued
+        ]
+        for path in paths:
+            log.info(f"Retrying upload of {path.name} ...")
+            self._queue(path.name, path.read_bytes(), path)
+        return len(paths)
+
+    def close(self):
+        """
+        Wait for queued uploads to finish
+        """
+        self._executor.shutdown(wait=True)
+        if self.failed:
+            log.warning(
+                f"{self.failed} uploads failed, to be retried from {self.spool_dir}."
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,22 +1,61 @@
+import hashlib
 import logging
-from typing import List
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Iterator, List, Tuple
 
 import boto3
 from bits import constants
 import botocore
+import botocore.config
 from django.conf import settings
 
 log = logging.getLogger(__name__)
 
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Return the process-wide s3 client
+
+    The client is created once per process, with a connection pool shared by
+    all threads, so credentials and endpoint are resolved once and TLS
+    connections are kept alive and reused between calls
+    """
+    global _s3_client, _s3_client_pid  # pylint: disable=global-statement
+    pid = os.getpid()
+    if _s3_client is None or _s3_client_pid != pid:
+        with _s3_client_lock:
+            # connection pools must not be shared with forked processes
+            if _s3_client is None or _s3_client_pid != pid:
+                session = boto3.session.Session()
+                _s3_client = session.client(
+                    service_name="s3",
+                    aws_access_key_id=settings.S3_ACCESS_KEY,
+                    aws_secret_access_key=settings.S3_SECRET_KEY,
+                    endpoint_url=settings.S3_ENDPOINT_URL,
+                    config=botocore.config.Config(
+                        max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                        connect_timeout=settings.S3_CONNECT_TIMEOUT,
+                        read_timeout=settings.S3_READ_TIMEOUT,
+                        retries={
+                            "max_attempts": settings.S3_MAX_ATTEMPTS,
+                            "mode": "standard",
+                        },
+                        tcp_keepalive=True,
+                    ),
+                )
+                _s3_client_pid = pid
+    return _s3_client
+
 
 def upload_to_s3(key: str, content: bytes | str) -> str:
-    session = boto3.session.Session()
-    s3 = session.client(
-        service_name="s3",
-        aws_access_key_id=settings.S3_ACCESS_KEY,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
-        endpoint_url=settings.S3_ENDPOINT_URL,
-    )
+    s3 = get_s3_client()
     resp = s3.put_object(
         Bucket=settings.S3_BUCKET_NAME,
         Key=key,
@@ -34,190 +73,351 @@ def upload_to_s3(key: str, content: bytes | str) -> str:
 
 
 def get_object_from_s3(key: str, offset: int = 0) -> bytes:
-    session = boto3.session.Session()
-    s3 = session.client(
-        service_name="s3",
-        aws_access_key_id=settings.S3_ACCESS_KEY,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
-        endpoint_url=settings.S3_ENDPOINT_URL,
-    )
+    s3 = get_s3_client()
     return s3.get_object(
         Bucket=settings.S3_BUCKET_NAME, Key=key, Range=f"bytes={offset}-"
     )["Body"]
 
 
+def get_object_range_from_s3(key: str, start: int, end: int) -> bytes:
+    """
+    Return bytes start through end (inclusive) of object, fewer at the end of
+    the object, or b"" if start is past the end
+    """
+    s3 = get_s3_client()
+    try:
+        return s3.get_object(
+            Bucket=settings.S3_BUCKET_NAME, Key=key, Range=f"bytes={start}-{end}"
+        )["Body"].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "InvalidRange":
+            return b""
+        raise
+
+
+def evict_lru(paths: List[Path], target: int) -> int:
+    """
+    Delete the least recently modified of paths until their total size is
+    at most target
+    Returns:
+        int: total size of the remaining paths
+    """
+    files = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    size = sum(size for _, size, _ in files)
+    for _, file_size, path in files:
+        if size <= target:
+            break
+        path.unlink(missing_ok=True)
+        size -= file_size
+    return size
+
+
+class S3RangeCache:
+    """
+    Read-through cache of s3 objects on local disk
+
+    Objects are cached in chunk_size aligned chunks, each fetched with a
+    bounded range request on first read. Chunks are keyed by object key and
+    etag, so once an object is re-uploaded, its stale chunks are no longer
+    read and age out. Once the cache grows past max_size, the least recently
+    read chunks are evicted.
+    """
+
+    def __init__(self, cache_dir: Path, max_size: int, chunk_size: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key: str, chunk: int, etag: str = "") -> Path:
+        digest = hashlib.sha256(f"{key}:{etag}".encode("utf8")).hexdigest()
+        return self.cache_dir / digest[:2] / f"{digest}.{self.chunk_size}.{chunk}"
+
+    def get_chunk(self, key: str, chunk: int, etag: str = "") -> bytes:
+        path = self._path(key, chunk, etag)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # mark as recently used
+            return data
+        except FileNotFoundError:
+            pass
+        start = chunk * self.chunk_size
+        data = get_object_range_from_s3(key, start, start + self.chunk_size - 1)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+        self._add(len(data))
+        return data
+
+    def _add(self, size: int):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(path.stat().st_size for path in self._files())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _files(self) -> List[Path]:
+        return [path for path in self.cache_dir.glob("*/*") if path.is_file()]
+
+    def _evict(self):
+        # other processes share the cache dir, so recount from disk
+        self._size = evict_lru(self._files(), self.max_size * 0.9)
+        log.info(f"Evicted s3 cache down to {self._size} bytes.")
+
+    def read(self, key: str, offset: int = 0, limit: int = -1, etag: str = "") -> bytes:
+        """
+        Read limit bytes of object from offset, or through the end of the
+        object if limit is -1
+        """
+        chunk = offset // self.chunk_size
+        skip = offset - chunk * self.chunk_size
+        remaining = None if limit == -1 else skip + limit
+        chunks = []
+        while remaining is None or remaining > 0:
+            data = self.get_chunk(key, chunk, etag)
+            chunks.append(data)
+            if remaining is not None:
+                remaining -= len(data)
+            if len(data) < self.chunk_size:
+                # end of object
+                break
+            chunk += 1
+        data = b"".join(chunks)[skip:]
+        return data if limit == -1 else data[:limit]
+
+
+_s3_range_cache = None
+
+
+def get_s3_range_cache() -> S3RangeCache | None:
+    """
+    Return the process-wide S3RangeCache, or None if the cache is disabled
+    """
+    global _s3_range_cache  # pylint: disable=global-statement
+    if not settings.S3_CACHE_MAX_SIZE:
+        return None
+    if _s3_range_cache is None:
+        _s3_range_cache = S3RangeCache(
+            settings.S3_CACHE_DIR,
+            settings.S3_CACHE_MAX_SIZE,
+            settings.S3_CACHE_CHUNK_SIZE,
+        )
+    return _s3_range_cache
+
+
+def read_object_from_s3(
+    key: str, offset: int = 0, limit: int = -1, etag: str = ""
+) -> bytes:
+    """
+    Read limit bytes of object from offset, or through the end of the object
+    if limit is -1, through the local s3 cache if enabled
+    Args:
+        etag: str, etag of the object per the s3 manifest, so chunks cached
+            before the object was re-uploaded aren't read
+    """
+    cache = get_s3_range_cache()
+    if cache is None:
+        if limit == -1:
+            return get_object_from_s3(key, offset=offset).read()
+        if limit == 0:
+            return b""
+        return get_object_range_from_s3(key, offset, offset + limit - 1)
+    return cache.read(key, offset, limit, etag)
+
+
+def iter_object_from_s3(
+    key: str, offset: int = 0, limit: int = -1, etag: str = ""
+) -> Iterator[bytes]:
+    """
+    Yield limit bytes of object from offset, or through the end of the object
+    if limit is -1, in chunks of at most settings.S3_CACHE_CHUNK_SIZE bytes,
+    through the local s3 cache if enabled
+    Args:
+        etag: str, etag of the object per the s3 manifest, so chunks cached
+            before the object was re-uploaded aren't read
+    """
+    cache = get_s3_range_cache()
+    chunk_size = settings.S3_CACHE_CHUNK_SIZE
+    remaining = limit
+    while remaining:
+        if cache is None:
+            size = chunk_size if remaining == -1 else min(chunk_size, remaining)
+            data = get_object_range_from_s3(key, offset, offset + size - 1)
+            end_of_object = len(data) < size
+        else:
+            # stay aligned to cached chunks
+            chunk = offset // chunk_size
+            data = cache.get_chunk(key, chunk, etag)
+            end_of_object = len(data) < chunk_size
+            data = data[offset - chunk * chunk_size :]
+            if remaining != -1:
+                data = data[:remaining]
+        if data:
+            yield data
+        if end_of_object:
+            return
+        offset += len(data)
+        if remaining != -1:
+            remaining -= len(data)
+
+
 def get_object_head_from_s3(key: str) -> True:
-    session = boto3.session.Session()
-    s3 = session.client(
-        service_name="s3",
-        aws_access_key_id=settings.S3_ACCESS_KEY,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
-        endpoint_url=settings.S3_ENDPOINT_URL,
-    )
+    s3 = get_s3_client()
     try:
         return s3.head_object(Bucket=settings.S3_BUCKET_NAME, Key=key)
     except botocore.exceptions.ClientError as e:
         return False
 
 
-def parse_inscriptions(witness_element: bytes | str) -> List[dict]:
+# OP_FALSE OP_IF OP_PUSHBYTES3 ord
+ORD_ENVELOPE = re.compile(re.escape(b"\x00\x63\x03ord"))
+
+# small-number opcodes which may be used to push a tag
+TAG_OPCODES = {
+    constants.OP_0: b"\x00",
+    constants.OP_1: b"\x01",
+    constants.OP_2: b"\x02",
+    constants.OP_3: b"\x03",
+    constants.OP_5: b"\x05",
+}
+
+
+def read_push(buf: memoryview, i: int) -> Tuple[memoryview, int]:
+    """
+    Read the data push starting at cursor i, without copying
+    Args:
+        buf: memoryview, script bytes
+        i: int, cursor positioned at the push opcode
+    Returns:
+        Tuple[memoryview, int]: pushed data, cursor positioned after the push
+    """
+    opcode = buf[i]
+    if 1 <= opcode < constants.OP_PUSHDATA1:
+        start = i + 1
+        push = opcode
+    elif opcode == constants.OP_PUSHDATA1:
+        start = i + 2
+        if start > len(buf):
+            raise ValueError("Truncated OP_PUSHDATA1")
+        push = buf[i + 1]
+    elif opcode == constants.OP_PUSHDATA2:
+        start = i + 3
+        if start > len(buf):
+            raise ValueError("Truncated OP_PUSHDATA2")
+        push = int.from_bytes(buf[i + 1 : start], "little")
+    else:
+        raise ValueError(f"Invalid data push: {opcode}")
+    end = start + push
+    if end > len(buf):
+        raise ValueError(f"Data push of {push} bytes exceeds script length")
+    return buf[start:end], end
+
+
+def parse_inscriptions(witness_element: bytes | memoryview | str) -> List[dict]:
     """
     Parse witness stack element for inscriptions
+
+    The element is walked once with an integer cursor over a memoryview, body
+    chunks are collected and joined once per inscription, so parsing time is
+    linear in the size of the element
     Args:
-        witness_element: bytes | str, The witness stack element to parse
+        witness_element: bytes | memoryview | str, The witness stack element to parse
     Returns:
         List[dict]: List of inscriptions
             dict for each inscription, respectively, contains keys:
                 content_type: str
                 data: bytes
-                delegate: bytes
+                delegate: str
                 metadata: bytes
-                pointer: bytes
+                pointer: int
                 properties: bytes
+                provenance: str
     """
-    if type(witness_element) is str:
+    if isinstance(witness_element, str):
         witness_element = bytes.fromhex(witness_element)
+    buf = memoryview(witness_element)
+    length = len(buf)
     inscriptions = []
-    ord_envelope_begin = witness_element.find(
-        b"\x00\x63\x03ord"
-    )  # OP_FALSE OP_IF OP_PUSHBYTES3 ord
-    while ord_envelope_begin != -1:
+    envelope = ORD_ENVELOPE.search(buf)
+    while envelope is not None:
         inscription = {}
+        data = None
+        metadata = []
+        properties = []
 
-        witness_element = witness_element[ord_envelope_begin:]
-        witness_element = witness_element[
-            6:
-        ]  # skip 'OP_FALSE OP_IF OP_PUSHBYTES3 ord' preamble
-
-        while witness_element and witness_element[0] != constants.OP_ENDIF:
+        i = envelope.end()  # skip 'OP_FALSE OP_IF OP_PUSHBYTES3 ord' preamble
+        while i < length and buf[i] != constants.OP_ENDIF:
             # parse the OP_PUSH and tag
-            if witness_element[0] in range(1, 0x4C):
-                push = witness_element[0]
-                tag = witness_element[1 : 1 + push]
-                witness_element = witness_element[1 + push :]
-            elif witness_element[0] == constants.OP_PUSHDATA1:
-                push = witness_element[1]
-                tag = witness_element[2 : 2 + push]
-                witness_element = witness_element[2 + push :]
-            elif witness_element[0] == constants.OP_PUSHDATA2:
-                push = int.from_bytes(witness_element[1:3], "little")
-                tag = witness_element[3 : 3 + push]
-                witness_element = witness_element[3 + push :]
-            elif witness_element[0] == constants.OP_0:
-                tag = b"\x00"
-                witness_element = witness_element[1:]
-            elif witness_element[0] == constants.OP_1:
-                tag = b"\x01"
-                witness_element = witness_element[1:]
-            elif witness_element[0] == constants.OP_2:
-                tag = b"\x02"
-                witness_element = witness_element[1:]
-            elif witness_element[0] == constants.OP_3:
-                tag = b"\x03"
-                witness_element = witness_element[1:]
-            elif witness_element[0] == constants.OP_5:
-                tag = b"\x05"
-                witness_element = witness_element[1:]
+            opcode = buf[i]
+            if opcode in TAG_OPCODES:
+                tag = TAG_OPCODES[opcode]
+                i += 1
+            elif 1 <= opcode <= constants.OP_PUSHDATA2:
+                tag, i = read_push(buf, i)
+                tag = bytes(tag)
             else:
-                raise ValueError(
-                    f"Invalid data push while parsing tag: {witness_element[0]}"
-                )
+                raise ValueError(f"Invalid data push while parsing tag: {opcode}")
+            if tag != b"\x00" and i >= length:
+                raise ValueError(f"Missing value for tag: {tag}")
+
             if tag == b"\x01":
                 # content type
-                push = witness_element[0]
-                content_type = witness_element[1 : 1 + push].decode("utf8")
-                witness_element = witness_element[1 + push :]
-                inscription["content_type"] = content_type
+                content_type, i = read_push(buf, i)
+                inscription["content_type"] = str(content_type, "utf8")
             elif tag == b"\x00":
                 # data
-                data = b""
-                while witness_element and witness_element[0] != 104:
-                    if witness_element[0] in range(1, 0x4C):
-                        push = witness_element[0]
-                        data += witness_element[1 : 1 + push]
-                        witness_element = witness_element[1 + push :]
-                    elif witness_element[0] == 0x4C:  # OP_PUSHDATA1
-                        push = witness_element[1]
-                        data += witness_element[2 : 2 + push]
-                        witness_element = witness_element[2 + push :]
-                    elif witness_element[0] == 0x4D:  # OP_PUSHDATA2
-                        push = int.from_bytes(witness_element[1:3], "little")
-                        data += witness_element[3 : 3 + push]
-                        witness_element = witness_element[3 + push :]
-                    else:
-                        raise ValueError(f"Invalid data push: {witness_element[0]}")
-                inscription["data"] = data
+                data = []
+                while i < length and buf[i] != constants.OP_ENDIF:
+                    chunk, i = read_push(buf, i)
+                    data.append(chunk)
             elif tag == b"\x0b":
                 # delegate
                 # parse txid and index
-                push = witness_element[0]
-                delegate = witness_element[1 : 1 + push]
-                witness_element = witness_element[1 + push :]
-                txid = delegate[:32][::-1].hex()
+                delegate, i = read_push(buf, i)
+                txid = bytes(delegate[:32])[::-1].hex()
                 index = int.from_bytes(delegate[32:], "little")
                 inscription["delegate"] = f"{txid}i{index}"
             elif tag == b"\x05":
                 # metadata
-                metadata = b""
-                if witness_element[0] in range(1, 0x4C):
-                    push = witness_element[0]
-                    metadata += witness_element[1 : 1 + push]
-                    witness_element = witness_element[1 + push :]
-                elif witness_element[0] == 0x4C:  # OP_PUSHDATA1
-                    push = witness_element[1]
-                    metadata += witness_element[2 : 2 + push]
-                    witness_element = witness_element[2 + push :]
-                elif witness_element[0] == 0x4D:  # OP_PUSHDATA2
-                    push = int.from_bytes(witness_element[1:3], "little")
-                    metadata += witness_element[3 : 3 + push]
-                    witness_element = witness_element[3 + push :]
-                else:
-                    raise ValueError(f"Invalid data push: {witness_element[0]}")
-                if inscription.get("metadata", None) is None:
-                    inscription["metadata"] = metadata
-                else:
-                    inscription["metadata"] += metadata
+                chunk, i = read_push(buf, i)
+                metadata.append(chunk)
             elif tag == b"\x02":
                 # pointer
-                push = witness_element[0]
-                pointer = witness_element[1 : 1 + push]
-                witness_element = witness_element[1 + push :]
+                pointer, i = read_push(buf, i)
                 inscription["pointer"] = int.from_bytes(pointer, "little")
             elif tag == b"\x11":
                 # properties
-                properties = b""
-                if witness_element[0] in range(1, 0x4C):
-                    push = witness_element[0]
-                    properties += witness_element[1 : 1 + push]
-                    witness_element = witness_element[1 + push :]
-                elif witness_element[0] == 0x4C:  # OP_PUSHDATA1
-                    push = witness_element[1]
-                    properties += witness_element[2 : 2 + push]
-                    witness_element = witness_element[2 + push :]
-                elif witness_element[0] == 0x4D:  # OP_PUSHDATA2
-                    push = int.from_bytes(witness_element[1:3], "little")
-                    properties += witness_element[3 : 3 + push]
-                    witness_element = witness_element[3 + push :]
-                else:
-                    raise ValueError(f"Invalid data push: {witness_element[0]}")
-                if inscription.get("properties", None) is None:
-                    inscription["properties"] = properties
-                else:
-                    inscription["properties"] += properties
+                chunk, i = read_push(buf, i)
+                properties.append(chunk)
             elif tag == b"\x03":
                 # provenance
                 # parse txid
-                push = witness_element[0]
-                provenance = witness_element[1 : 1 + push]
-                witness_element = witness_element[1 + push :]
-                txid = provenance[:32][::-1].hex()
+                provenance, i = read_push(buf, i)
+                txid = bytes(provenance[:32])[::-1].hex()
                 index = int.from_bytes(provenance[32:], "little")
                 inscription["provenance"] = f"{txid}i{index}"
             else:
                 raise ValueError(f"Unexpected tag: {tag}")
+        if data is not None:
+            inscription["data"] = b"".join(data)
+        if metadata:
+            inscription["metadata"] = b"".join(metadata)
+        if properties:
+            inscription["properties"] = b"".join(properties)
         inscriptions.append(inscription)
 
-        ord_envelope_begin = witness_element.find(b"\x00\x63\x03ord")
+        envelope = ORD_ENVELOPE.search(buf, i)
 
     return inscriptions
 
@@ -1,8 +1,13 @@
 import base64
+import binascii
+import hashlib
 import io
 import json
 import logging
+import mimetypes
+import os
 import time
+from collections import Counter
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -14,17 +19,29 @@ from bits import to_bitcoin_address
 from bits.blockchain import Block
 from bits.bips.bip32 import deserialized_extended_key
 from bits.wallet.hd import derive_from_path
-from django.http import JsonResponse, HttpResponseBadRequest, FileResponse
+from django.http import (
+    JsonResponse,
+    HttpResponse,
+    HttpResponseBadRequest,
+    FileResponse,
+    Http404,
+    StreamingHttpResponse,
+)
 from django.conf import settings
-from django.core.paginator import Paginator
-from django.db.models import Q, F
+from django.core.cache import cache
+from django.db.models import F, FloatField, Max, Q
+from django.db.models.functions import Cast
 from django.contrib.postgres.search import SearchQuery, SearchRank
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render, get_object_or_404, redirect
+from django.utils.http import http_date
 from glclient import Credentials, Scheduler, clnpb
 
 
 from . import models
-from .utils import get_object_from_s3, get_object_head_from_s3, readable_size
+from .facets import get_facets
+from .mediastore import get_media_store
+from .blockarchive import get_block_json_path, get_block_size, iter_block, read_block
+from .utils import readable_size
 
 
 log = logging.getLogger(__name__)
@@ -55,10 +72,147 @@ def block_info(request):
 
 
 def content_types(request):
-    # mime_type in the content model is actually {mime_type}/{mime_subtype}
-    # TODO: content model needs to be reworked or removed, but maybe can eventually be refactored for search indexing
-    mime_types = models.Content.objects.values_list("mime_type", flat=True).distinct()
-    return render(request, "components/content_types.html", {"mime_types": mime_types})
+    # content counts per mime type, from the cached facet table
+    mime_types = Counter()
+    for facet in get_facets():
+        mime_types[facet["mime_type"]] += facet["count"]
+    return render(
+        request,
+        "components/content_types.html",
+        {
+            "mime_types": sorted(mime_types.items()),
+            "query_content_types": request.GET.getlist("mime_type"),
+        },
+    )
+
+
+PAGE_SIZE = 12
+
+
+def encode_cursor(values: list) -> str:
+    """
+    Encode values of the ordering keys of the last row of a page as an opaque
+    cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> list:
+    """
+    Decode cursor from encode_cursor
+    Raises:
+        ValueError: if cursor is malformed
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (UnicodeError, binascii.Error, json.JSONDecodeError) as err:
+        raise ValueError(f"malformed cursor: {err}") from err
+    if not isinstance(values, list) or not all(
+        isinstance(value, (int, float)) for value in values
+    ):
+        raise ValueError("malformed cursor")
+    return values
+
+
+def keyset_q(keys: list, values: list) -> Q:
+    """
+    Filter for rows after the row with values in the ordering by keys, so
+    pages are read by an index range scan rather than with OFFSET
+    Args:
+        keys: List[tuple], (field, descending) in order
+        values: list, values of the fields of the last row of the previous page
+    """
+
+    def after(keys: list, values: list) -> Q:
+        (field, descending), *rest = keys
+        q = Q(**{f"{field}__{'lt' if descending else 'gt'}": values[0]})
+        if rest:
+            q |= Q(**{field: values[0]}) & after(rest, values[1:])
+        return q
+
+    # bound the first key on its own as well, which the index scan can start from
+    field, descending = keys[0]
+    return Q(**{f"{field}__{'lte' if descending else 'gte'}": values[0]}) & after(
+        keys, values
+    )
+
+
+def card_block_binary(content: models.Content) -> str:
+    """
+    Binary string of the block header and coinbase tx behind a coinbase card,
+    precomputed at ingest. Computed and saved on first view for cards of
+    blocks indexed before that.
+    """
+    card = content.card
+    if card.block_binary is None:
+        card.block_binary = Block(content.block.serialized()).bin()
+        models.ResultCard.objects.filter(pk=card.pk).update(
+            block_binary=card.block_binary
+        )
+    return card.block_binary
+
+
+def search_cache_key(
+    query: str, mime_types: list, filters: list, start: str, end: str, order: str
+) -> str:
+    """
+    Cache key of search matches, from the normalized query and filters and
+    the latest indexed block, so matches are searched again once a block is
+    indexed
+    """
+    latest_block_id = models.Block.objects.aggregate(Max("id"))["id__max"]
+    normalized = [
+        " ".join(query.lower().split()),
+        sorted(set(mime_types)),
+        sorted(set(filters)),
+        start,
+        end or None,
+        order == "asc",
+        latest_block_id,
+    ]
+    return "search:" + hashlib.sha256(json.dumps(normalized).encode("utf8")).hexdigest()
+
+
+def cached_search_page(
+    content_objects, keys: list, values: list, cache_key: str
+) -> list | None:
+    """
+    Page of search results after the row with values, sliced from the ordered
+    matches cached under cache_key. Matches are cached for
+    settings.SEARCH_CACHE_TIMEOUT, up to settings.SEARCH_CACHE_MAX_RESULTS.
+    Args:
+        content_objects: QuerySet, ordered search over Content
+        keys: List[tuple], (field, descending) of the ordering, id last
+        values: list, values of the fields of the last row of the previous
+            page, or None for the first page
+    Returns:
+        List[tuple]: (values of the fields, Content), up to PAGE_SIZE + 1
+            rows, or None if the page isn't within the cached matches
+    """
+    hits = cache.get(cache_key)
+    if hits is None:
+        hits = [
+            list(hit)
+            for hit in content_objects.values_list(*(field for field, _ in keys))[
+                : settings.SEARCH_CACHE_MAX_RESULTS
+            ]
+        ]
+        cache.set(cache_key, hits, settings.SEARCH_CACHE_TIMEOUT)
+    position = 0
+    if values is not None:
+        position = next(
+            (i + 1 for i, hit in enumerate(hits) if hit[-1] == values[-1]), None
+        )
+        if position is None:
+            return None
+    page_hits = hits[position : position + PAGE_SIZE + 1]
+    if len(page_hits) <= PAGE_SIZE and len(hits) >= settings.SEARCH_CACHE_MAX_RESULTS:
+        # runs past the truncated matches, whether there's a next page is unknown
+        return None
+    contents = models.Content.objects.select_related("card").in_bulk(
+        [hit[-1] for hit in page_hits]
+    )
+    return [(hit, contents[hit[-1]]) for hit in page_hits if hit[-1] in contents]
 
 
 def index(request):
@@ -79,7 +233,7 @@ def index(request):
         elif filter_ == "brc-20":
             content_query &= Q(is_brc20=False)
     content_objects = models.Content.objects.filter(content_query).select_related(
-        "inscription", "op_return", "coinbase_scriptsig"
+        "card"
     )
 
     content_query = Q()
@@ -103,74 +257,78 @@ def index(request):
         content_query &= Q(block_height__lte=int(end))
     content_objects = content_objects.filter(content_query)
 
+    # total ordering, with id breaking ties between content of the same block
+    keys = [("block_time", order != "asc"), ("id", order != "asc")]
     if query:
         search_query = SearchQuery(query, config="english")
-        content_objects = (
-            content_objects.filter(search_vector=search_query)
-            .annotate(rank=SearchRank(F("search_vector"), search_query))
-            .order_by(
-                "-rank",  # Sort by relevance first
-                "block_time" if order == "asc" else "-block_time",  # Then by time
-            )
-        )
-    else:
-        # If no query, just order by time
-        content_objects = content_objects.order_by(
-            "block_time" if order == "asc" else "-block_time"
+        # ts_rank is a real, which doesn't round trip through a float in the
+        # cursor, so ties on rank would be skipped or repeated across pages
+        content_objects = content_objects.filter(search_vector=search_query).annotate(
+            rank=Cast(SearchRank(F("search_vector"), search_query), FloatField())
         )
-    paginator = Paginator(content_objects, 12)
-    page = request.GET.get("page")
-    page_objects = paginator.get_page(page)
-
-    for obj in page_objects:
-        if obj.inscription:
-            object_type = "Inscription"
-            filename = obj.inscription.filename
-            text = obj.inscription.text
-            text_json = obj.inscription.json
-            block = obj.inscription.txin.tx.block
-            txid = obj.inscription.txin.tx.txid
-        elif obj.op_return:
-            object_type = "OpReturn"
-            filename = None
-            text = obj.op_return.scriptpubkey_text
-            text_json = None
-            block = obj.op_return.txout.tx.block
-            txid = obj.op_return.txout.tx.txid
-        elif obj.coinbase_scriptsig:
-            object_type = "CoinbaseScriptsig"
-            filename = None
-            text = obj.coinbase_scriptsig.scriptsig_text
-            text_json = None
-            block = obj.coinbase_scriptsig.txin.tx.block
-            txid = obj.coinbase_scriptsig.txin.tx.txid
-        else:
-            return HttpResponseBadRequest()
-        url = f"/context/{obj.context_revision.id}"
+        # Sort by relevance first, then by time
+        keys.insert(0, ("rank", True))
+    content_objects = content_objects.order_by(
+        *(f"-{field}" if descending else field for field, descending in keys)
+    )
+
+    values = None
+    cursor = request.GET.get("cursor")
+    if cursor:
+        try:
+            values = decode_cursor(cursor)
+            if len(values) != len(keys):
+                raise ValueError("cursor doesn't match ordering")
+        except ValueError:
+            return HttpResponseBadRequest("invalid cursor")
 
-        block_timestamp = datetime.fromtimestamp(block.time, tz=timezone.utc).strftime(
-            "%Y-%m-%d %H:%M:%S %Z"
+    page = None
+    if query:
+        page = cached_search_page(
+            content_objects,
+            keys,
+            values,
+            search_cache_key(query, mime_types, filters, start, end, order),
         )
+    if page is None:
+        if values is not None:
+            content_objects = content_objects.filter(keyset_q(keys, values))
+        page = [
+            ([getattr(obj, field) for field, _ in keys], obj)
+            for obj in content_objects[: PAGE_SIZE + 1]
+        ]
+    has_next = len(page) > PAGE_SIZE
+    page = page[:PAGE_SIZE]
+
+    for _, obj in page:
+        card = obj.card
+        block_timestamp = datetime.fromtimestamp(
+            obj.block_time, tz=timezone.utc
+        ).strftime("%Y-%m-%d %H:%M:%S %Z")
+        if card.object_type == "CoinbaseScriptsig":
+            block_binary = card_block_binary(obj)
+        else:
+            block_binary = None
 
         results.append(
             {
-                "object_type": object_type,
+                "object_type": card.object_type,
                 "mime_type": obj.mime_type,
                 "mime_subtype": obj.mime_subtype,
-                "url": url,
-                "filename": filename,
-                "text": text,
-                "text_json": text_json,
-                "blockheight": block.blockheight,
+                "url": f"/context/{obj.hash.hex()}",
+                "filename": card.filename,
+                "text": card.text,
+                "text_json": card.text_json,
+                "blockheight": obj.block_height,
                 "block_timestamp": block_timestamp,
-                "txid": txid,
-                "block_binary": Block(block.serialized()).bin(),
+                "txid": card.txid,
+                "block_binary": block_binary,
             }
         )
 
     qd = request.GET.copy()
-    if page_objects.has_next():
-        qd["page"] = page_objects.next_page_number()
+    if has_next:
+        qd["cursor"] = encode_cursor(page[-1][0])
         next_page_url = request.path + "?" + qd.urlencode()
     else:
         next_page_url = None
@@ -194,8 +352,27 @@ def index(request):
     )
 
 
+def archived_block_size(block: models.Block) -> int:
+    """
+    Size of the raw block, read from the archive and saved for blocks indexed
+    before it was recorded
+    Raises:
+        Http404: if the block isn't archived
+    """
+    if block.size is None:
+        block.size = get_block_size(block.blockheight)
+        if block.size is None:
+            raise Http404(f"block {block.blockheight} not archived")
+        models.Block.objects.filter(pk=block.pk).update(size=block.size)
+    return block.size
+
+
 def block(request, block_identifier: str):
     offset = request.GET.get("offset", 0)
+    try:
+        offset = max(int(offset), 0)
+    except ValueError:
+        offset = 0
     limit = request.GET.get("limit", 1024)
     try:
         limit = int(limit)
@@ -205,11 +382,6 @@ def block(request, block_identifier: str):
     if fmt not in ["hex", "json"]:
         # default to hex if format is not valid
         fmt = "hex"
-    # determine file ext in s3 based on fmt
-    if fmt == "hex":
-        ext = ".bin"
-    elif fmt == "json":
-        ext = ".json"
 
     try:
         blockheight = int(block_identifier)
@@ -218,44 +390,21 @@ def block(request, block_identifier: str):
         blockheaderhash = block_identifier
         block = get_object_or_404(models.Block, blockheaderhash=blockheaderhash)
 
-    block_head_s3 = get_object_head_from_s3(f"block{block.blockheight}{ext}")
-    if limit == -1:
-        if fmt == "hex":
-            content = (
-                get_object_from_s3(f"block{block.blockheight}.bin", offset=offset)
-                .read()
-                .hex()
-            )
-        elif fmt == "json":
-            content = (
-                get_object_from_s3(f"block{block.blockheight}.json", offset=offset)
-                .read()
-                .decode("utf-8")
-            )
-        else:
-            content = ""
+    if fmt == "hex":
+        contentlength = archived_block_size(block)
+        content = read_block(block.blockheight, offset=offset, limit=limit).hex()
     else:
-        if fmt == "hex":
-            print(offset)
-            content = (
-                get_object_from_s3(f"block{block.blockheight}.bin", offset=offset)
-                .read(limit)
-                .hex()
-            )
-        elif fmt == "json":
-            content = (
-                get_object_from_s3(f"block{block.blockheight}.json", offset=offset)
-                .read(limit)
-                .decode("utf-8")
-            )
-        else:
-            content = ""
+        block_json_path = get_block_json_path(block.blockheight)
+        with block_json_path.open("rb") as fp:
+            contentlength = os.fstat(fp.fileno()).st_size
+            fp.seek(offset)
+            content = fp.read(limit).decode("utf-8")
 
     if request.headers.get("Content-Type") == "application/json":
         return JsonResponse(
             {
-                "readable_size": readable_size(block_head_s3.get("ContentLength")),
-                "contentlength": block_head_s3.get("ContentLength"),
+                "readable_size": readable_size(contentlength),
+                "contentlength": contentlength,
                 "fmt": fmt,
                 "offset": int(offset),
                 "limit": int(limit),
@@ -268,8 +417,8 @@ def block(request, block_identifier: str):
         request,
         "block.html",
         context={
-            "readable_size": readable_size(block_head_s3.get("ContentLength")),
-            "contentlength": block_head_s3.get("ContentLength"),
+            "readable_size": readable_size(contentlength),
+            "contentlength": contentlength,
             "fmt": fmt,
             "offset": int(offset),
             "limit": int(limit),
@@ -280,13 +429,143 @@ def block(request, block_identifier: str):
     )
 
 
-def tx(request, txid: str):
-    tx = get_object_or_404(models.Tx, txid=txid)
-    block_data = get_object_from_s3(f"block{tx.block.blockheight}.bin").read()
-    block = Block(block_data).dict(json_serializable=True)
-    tx_json = json.dumps(
-        next(filter(lambda tx_: tx_["txid"] == txid, block["txns"])), indent=2
+def parse_range(range_header: str, size: int) -> tuple | None:
+    """
+    Parse a single byte range Range header against a representation of size
+    bytes
+    Returns:
+        tuple: (first byte, last byte) inclusive, or None if the header is
+            missing, malformed or requests multiple ranges, in which case the
+            full representation should be served
+    Raises:
+        ValueError: if the range is not satisfiable
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes=") :].strip()
+    if "," in spec or "-" not in spec:
+        return None
+    first, last = (part.strip() for part in spec.split("-", 1))
+    if (
+        not (first or last)
+        or not (first or "0").isdigit()
+        or not (last or "0").isdigit()
+    ):
+        return None
+    if not first:
+        # suffix range, last n bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError(f"unsatisfiable range {range_header}")
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if last and first > int(last):
+        return None
+    if first >= size:
+        raise ValueError(f"unsatisfiable range {range_header}")
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+def iter_hex(chunks, skip: int, length: int):
+    """
+    Hex encode chunks, dropping the first skip hex characters and stopping
+    after length hex characters
+    """
+    for chunk in chunks:
+        text = chunk.hex()[skip : length + skip]
+        skip = 0
+        if not text:
+            continue
+        length -= len(text)
+        yield text
+        if length <= 0:
+            return
+
+
+def block_raw(request, block_identifier: str):
+    """
+    Stream the stored block as binary (fmt=bin), hex (fmt=hex) or json
+    (fmt=json, rendered from the binary and cached), chunk by chunk, honoring
+    single byte range Range requests
+    """
+    fmt = request.GET.get("fmt", "bin")
+    if fmt not in ["bin", "hex", "json"]:
+        return HttpResponseBadRequest(f"invalid fmt {fmt}")
+
+    try:
+        blockheight = int(block_identifier)
+        block = get_object_or_404(models.Block, blockheight=blockheight)
+    except ValueError:
+        blockheaderhash = block_identifier
+        block = get_object_or_404(models.Block, blockheaderhash=blockheaderhash)
+
+    if fmt == "json":
+        block_json_file = get_block_json_path(block.blockheight).open("rb")
+        size = os.fstat(block_json_file.fileno()).st_size
+    else:
+        block_size = archived_block_size(block)
+        # hex is 2 chars per byte
+        size = block_size * (2 if fmt == "hex" else 1)
+    content_type = {
+        "bin": "application/octet-stream",
+        "hex": "text/plain; charset=utf-8",
+        "json": "application/json",
+    }[fmt]
+
+    try:
+        byte_range = parse_range(request.headers.get("Range"), size)
+    except ValueError:
+        if fmt == "json":
+            block_json_file.close()
+        response = HttpResponse(status=416, content_type=content_type)
+        response["Content-Range"] = f"bytes */{size}"
+        response["Accept-Ranges"] = "bytes"
+        return response
+    first, last = byte_range if byte_range else (0, size - 1)
+    length = last - first + 1
+
+    if fmt == "hex":
+        chunks = iter_hex(
+            iter_block(
+                block.blockheight,
+                offset=first // 2,
+                limit=last // 2 - first // 2 + 1,
+            ),
+            skip=first % 2,
+            length=length,
+        )
+    elif fmt == "json":
+        chunks = iter_file_range(block_json_file, first, length)
+    else:
+        chunks = iter_block(block.blockheight, offset=first, limit=length)
+
+    response = StreamingHttpResponse(
+        chunks, status=206 if byte_range else 200, content_type=content_type
     )
+    response["Content-Length"] = str(length)
+    response["Accept-Ranges"] = "bytes"
+    if byte_range:
+        response["Content-Range"] = f"bytes {first}-{last}/{size}"
+    if fmt == "bin":
+        response["Content-Disposition"] = (
+            f'inline; filename="block{block.blockheight}.bin"'
+        )
+    return response
+
+
+def tx(request, txid: str):
+    tx = get_object_or_404(models.Tx.objects.select_related("block"), txid=txid)
+    blockheight = tx.block.blockheight
+    if tx.offset is None:
+        # indexed before tx offsets were recorded, scan the whole block
+        block = Block(read_block(blockheight)).dict(json_serializable=True)
+        tx_data = next(filter(lambda tx_: tx_["txid"] == txid, block["txns"]))
+    else:
+        raw_tx = read_block(blockheight, offset=tx.offset, limit=tx.size)
+        # decode as the only tx of a block, for the same json as the full block
+        tx_data = Block(tx.block.header() + b"\x01" + raw_tx).dict(
+            json_serializable=True
+        )["txns"][0]
+    tx_json = json.dumps(tx_data, indent=2)
     return render(
         request,
         "tx.html",
@@ -297,29 +576,55 @@ def tx(request, txid: str):
     )
 
 
-def context_revision(request, context_id):
+def get_content_or_404(content_hash: str) -> models.Content:
+    try:
+        content_hash = bytes.fromhex(content_hash)
+    except ValueError:
+        raise Http404("Invalid content hash")
+    return get_object_or_404(models.Content, hash=content_hash)
+
+
+def context_revision(request, content_hash: str):
+    content = get_content_or_404(content_hash)
     if request.method == "POST":
         context_html = request.POST["context_html"]
-        context_ = get_object_or_404(models.ContextRevision, id=context_id)
-        context_.html = context_html
-        context_.save()
-        return render(
-            request,
-            "components/context_editor.html",
-            context={"context_html": context_html, "context_id": context_.id},
-        )
+        if content.context_revision is None:
+            # context revisions are only created on first edit
+            content.context_revision = models.ContextRevision.objects.create(
+                html=context_html
+            )
+            content.save(update_fields=["context_revision"])
+        else:
+            content.context_revision.html = context_html
+            content.context_revision.save()
     else:  # GET
-        context_ = get_object_or_404(models.ContextRevision, id=context_id)
-        return render(
-            request,
-            "components/context_editor.html",
-            context={"context_html": context_.html, "context_id": context_.id},
-        )
+        context_html = content.context_revision.html if content.context_revision else ""
+    return render(
+        request,
+        "components/context_editor.html",
+        context={"context_html": context_html, "context_id": content_hash},
+    )
+
 
+def context_legacy(request, context_id: int):
+    # context used to be addressed by context revision id; ids of revisions
+    # which were never edited live on in LegacyContext
+    content_hash = (
+        models.Content.objects.filter(context_revision_id=context_id)
+        .values_list("hash", flat=True)
+        .first()
+    )
+    if content_hash is None:
+        content_hash = get_object_or_404(
+            models.LegacyContext, pk=context_id
+        ).content_hash
+    return redirect(f"/context/{bytes(content_hash).hex()}", permanent=True)
 
-def context(request, context_id: int):
-    context_row = models.ContextRevision.objects.get(id=context_id)
-    content = context_row.content_set.first()
+
+def context(request, content_hash: str):
+    content = get_content_or_404(content_hash)
+    context_row = content.context_revision
+    context_html = context_row.html if context_row else ""
     if content.inscription:
         object_type = "Inscription"
         if content.inscription.metadata:
@@ -355,8 +660,12 @@ def context(request, context_id: int):
             "content_metadata": metadata,
             "mime_type": content.mime_type.split("/")[0],
             "context": context_row,
+            "context_id": content_hash,
+            "context_html": context_html,
             "context_revision_hash": bits.crypto.hash256(
-                (str(context_row.id) + context_row.html).encode("utf-8")
+                ((str(context_row.id) if context_row else "") + context_html).encode(
+                    "utf-8"
+                )
             ).hex(),
         },
     )
@@ -401,6 +710,88 @@ def lit(request):
     )
 
 
+def iter_file_range(fp, offset: int, length: int, chunk_size: int = 64 * 1024):
+    """
+    Yield length bytes of file from offset in chunks, closing it when done
+    """
+    try:
+        fp.seek(offset)
+        while length > 0:
+            data = fp.read(min(chunk_size, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+    finally:
+        fp.close()
+
+
 def media(request, filename: str):
-    filepath = Path(settings.MEDIA_ROOT) / filename
-    return FileResponse(filepath.open("rb"))
+    """
+    Serve media files, which are named by content hash and so are immutable
+
+    Responses carry a strong ETag from the content hash and are cacheable
+    indefinitely. Single byte range Range requests are answered with 206.
+    With settings.MEDIA_SENDFILE, the file is handed off to the front proxy
+    with an X-Accel-Redirect or X-Sendfile header instead of being read here.
+    """
+    if Path(filename).name != filename or filename.startswith("."):
+        raise Http404("invalid filename")
+    filepath = get_media_store().find(filename)
+    if filepath is None:
+        raise Http404(f"{filename} not found")
+    stat = filepath.stat()
+
+    etag = f'"{filename.split(".")[0]}"'
+    content_type, encoding = mimetypes.guess_type(filename)
+    if encoding:
+        # e.g. .gz files are served as is, not decoded by the browser
+        content_type = "application/octet-stream"
+    content_type = content_type or "application/octet-stream"
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(stat.st_mtime),
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in if_none_match or if_none_match.strip() == "*":
+        return HttpResponse(status=304, headers=headers)
+
+    if settings.MEDIA_SENDFILE == "x-accel-redirect":
+        # the proxy handles Range and conditional requests itself
+        headers["X-Accel-Redirect"] = (
+            f"{settings.MEDIA_SENDFILE_PREFIX}"
+            f"{filepath.relative_to(settings.MEDIA_ROOT).as_posix()}"
+        )
+        return HttpResponse(content_type=content_type, headers=headers)
+    if settings.MEDIA_SENDFILE == "x-sendfile":
+        headers["X-Sendfile"] = str(filepath.resolve())
+        return HttpResponse(content_type=content_type, headers=headers)
+
+    size = stat.st_size
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    if if_range and if_range != etag:
+        # resource changed from the client's view, send it whole
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{size}"
+        return HttpResponse(status=416, content_type=content_type, headers=headers)
+    if byte_range is None:
+        return FileResponse(
+            filepath.open("rb"), content_type=content_type, headers=headers
+        )
+
+    first, last = byte_range
+    headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    headers["Content-Length"] = str(last - first + 1)
+    return StreamingHttpResponse(
+        iter_file_range(filepath.open("rb"), first, last - first + 1),
+        status=206,
+        content_type=content_type,
+        headers=headers,
+    )